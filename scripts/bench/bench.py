@@ -0,0 +1,392 @@
+import argparse
+import atexit
+import contextlib
+import importlib.util
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# end to end throughput of the importers against mock_pds.py, on synthetic
+# data at a few sizes. reports records/sec, requests per endpoint, bytes
+# uploaded and peak python memory for each workload.
+#
+#   python bench.py                          # every workload, small + medium
+#   python bench.py discord tunes --sizes large --latency 0.05
+#   python bench.py --save baseline.json
+#   python bench.py --baseline baseline.json # exits 1 on a regression
+#
+# workloads whose script dependencies aren't installed are skipped.
+
+BENCH_DIR = Path(__file__).resolve().parent
+SCRIPTS_DIR = BENCH_DIR.parent
+
+# runs shouldn't reuse or pollute the real session/http/image caches
+if 'DREARY_CACHE_DIR' not in os.environ:
+    os.environ['DREARY_CACHE_DIR'] = tempfile.mkdtemp(prefix='dreary-bench-')
+    atexit.register(shutil.rmtree, os.environ['DREARY_CACHE_DIR'], True)
+
+sys.path.append(str(SCRIPTS_DIR))
+import requests
+from dreary_common.identity import get_session
+from dreary_common.writes import WriteScheduler, apply_writes_batch
+
+SIZES = ('small', 'medium', 'large')
+EMOJI = ['👍', '😂', '❤️', '🔥', '👀', '🎉']
+
+
+def load_script(relpath):
+    # the scripts aren't packages (and atp-renpy has a dash in it), so load
+    # them by path with their own directory importable for siblings
+    name = 'bench_' + Path(relpath).stem.replace('-', '_')
+    if name in sys.modules:
+        return sys.modules[name]
+    path = SCRIPTS_DIR / relpath
+    if str(path.parent) not in sys.path:
+        sys.path.append(str(path.parent))
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
+
+def fake_png(rng, size):
+    return b'\x89PNG\r\n\x1a\n' + rng.randbytes(size)
+
+def words(rng, count):
+    return ' '.join(rng.choice(['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'tunes', 'dreary', 'shelf', 'renpy', 'bsky']) for _ in range(count))
+
+# synthetic data
+
+def generate_writes(n, data_dir, rng):
+    return [{
+        '$type': 'dev.dreary.bench.record',
+        'text': words(rng, 12),
+        'index': i,
+        'createdAt': datetime.now(timezone.utc).isoformat(),
+    } for i in range(n)]
+
+def generate_discord(n, data_dir, rng, channels=4):
+    # a DiscordChatExporter guild export with media downloaded, one json
+    # file per channel
+    media = data_dir / 'export_Files'
+    media.mkdir()
+    (media / 'icon.png').write_bytes(fake_png(rng, 4096))
+    authors = []
+    for i in range(max(n // 25, 2)):
+        (media / f'avatar-{i}.png').write_bytes(fake_png(rng, 4096))
+        authors.append({
+            'id': str(200000000000000000 + i),
+            'name': f'user{i}',
+            'discriminator': '0000',
+            'nickname': f'User {i}',
+            'color': None,
+            'isBot': False,
+            'roles': [],
+            'avatarUrl': f'export_Files/avatar-{i}.png',
+        })
+    guild = {'id': '100000000000000000', 'name': 'bench', 'iconUrl': 'export_Files/icon.png'}
+
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    per_channel = -(-n // channels)
+    for c in range(channels):
+        messages = []
+        for i in range(c * per_channel, min((c + 1) * per_channel, n)):
+            message = {
+                'id': str(300000000000000000 + i),
+                'type': 'Default',
+                'timestamp': (start + timedelta(seconds=i * 37)).isoformat(timespec='milliseconds'),
+                'timestampEdited': None,
+                'callEndedTimestamp': None,
+                'isPinned': False,
+                'content': words(rng, rng.randrange(3, 30)),
+                'author': rng.choice(authors),
+                'attachments': [],
+                'embeds': [],
+                'stickers': [],
+                'reactions': [],
+                'mentions': [],
+            }
+            roll = rng.random()
+            if roll < 0.1:
+                message['mentions'] = [rng.choice(authors)]
+            if roll < 0.1 or roll > 0.95:
+                message['reactions'] = [{'emoji': {'id': '', 'name': rng.choice(EMOJI), 'code': 'emoji', 'isAnimated': False}, 'count': rng.randrange(1, 5)}]
+            if 0.1 <= roll < 0.15:
+                message['embeds'] = [{'title': words(rng, 4), 'url': f'https://example.com/{rng.randrange(n)}', 'description': words(rng, 20)}]
+            if 0.15 <= roll < 0.2:
+                path = media / f'attachment-{i}.png'
+                path.write_bytes(fake_png(rng, rng.randrange(8192, 65536)))
+                message['attachments'] = [{'id': str(400000000000000000 + i), 'url': f'export_Files/{path.name}', 'fileName': path.name, 'fileSizeBytes': path.stat().st_size}]
+            if 0.2 <= roll < 0.21:
+                sticker = rng.randrange(8)
+                if not (path := media / f'sticker-{sticker}.png').exists():
+                    path.write_bytes(fake_png(rng, 8192))
+                message['stickers'] = [{'id': str(500000000000000000 + sticker), 'name': f'sticker{sticker}', 'format': 'Png', 'sourceUrl': f'export_Files/{path.name}'}]
+            messages.append(message)
+        channel = {'id': str(110000000000000000 + c), 'type': 'GuildTextChat', 'categoryId': '1', 'category': 'bench', 'name': f'channel-{c}', 'topic': None}
+        with open(data_dir / f'channel-{c}.json', 'w', encoding='utf-8') as f:
+            json.dump({'guild': guild, 'channel': channel, 'messages': messages}, f)
+    return data_dir
+
+def generate_tunes(n, data_dir, rng):
+    # two bandcamp-shaped playlists that share half their tracks
+    def playlist(p):
+        return {
+            '$type': 'dev.dreary.tunes.playlist',
+            'thumbnail': f'https://f4.bcbits.com/img/a{p}_10.jpg',
+            'name': f'playlist {p}',
+            'description': words(rng, 10),
+            'createdAt': datetime.now(timezone.utc).isoformat(),
+            'reference': {'source': 'Bandcamp', 'link': f'https://bench.bandcamp.com/album/{p}', 'id': p},
+        }
+    def track(i):
+        return {
+            '$type': 'dev.dreary.tunes.track',
+            'title': words(rng, 3),
+            'uploader': {'name': 'bench', 'id': 1, 'url': 'https://bench.bandcamp.com'},
+            'thumbnail': f'https://f4.bcbits.com/img/a{i}_10.jpg',
+            'duration': rng.randrange(60, 600),
+            'lyrics': None,
+            'url': f'https://bench.bandcamp.com/track/{i}',
+            'id': i,
+            'source': 'Bandcamp',
+            'createdAt': datetime.now(timezone.utc).isoformat(),
+        }
+    tracks = [track(i) for i in range(n + n // 2)]
+    return [(playlist(1), tracks[:n]), (playlist(2), tracks[n // 2:])]
+
+def generate_library(n, data_dir, rng):
+    import fitz
+    for i in range(n):
+        doc = fitz.open()
+        for _ in range(rng.randrange(1, 8)):
+            doc.new_page().insert_text((72, 72), words(rng, 80))
+        doc.set_metadata({'title': f'book {i} {words(rng, 2)}', 'author': f'author {i % 17}, editor {i % 5}'})
+        doc.save(data_dir / f'book-{i}.pdf')
+        doc.close()
+    return data_dir
+
+def generate_renpy(n, data_dir, rng):
+    # scripts, images and audio, plus compiled files the uploader skips
+    for sub in ('images', 'audio', 'cache'):
+        (data_dir / sub).mkdir()
+    for i in range(n):
+        kind = i % 10
+        if kind < 4:
+            (data_dir / f'script{i}.rpy').write_text('\n'.join(f'    e "{words(rng, 8)}"' for _ in range(rng.randrange(20, 200))))
+        elif kind < 9:
+            (data_dir / 'images' / f'bg{i}.png').write_bytes(fake_png(rng, rng.randrange(16384, 131072)))
+        else:
+            (data_dir / 'audio' / f'track{i}.mp3').write_bytes(rng.randbytes(rng.randrange(65536, 262144)))
+        if kind < 4:
+            (data_dir / 'cache' / f'script{i}.rpyc').write_bytes(rng.randbytes(512))
+    return data_dir
+
+# workloads
+
+def run_writes(data, session, service):
+    apply_writes_batch(session, service, data)
+
+def run_discord(data_dir, session, service):
+    discord = load_script('discord/dreary_discord.py')
+    did = session['did']
+    input_files = sorted(data_dir.glob('*.json'))
+    tmp_dir = data_dir / 'tmp'
+    tmp_dir.mkdir()
+    guild = discord.load_export(input_files[0])['guild']
+    guild_uri = discord.find_or_create_guild(guild, did, service, session, data_dir, tmp_dir)
+    indexes = discord.populate_indexes(did, service)
+    writer = WriteScheduler(session, service)
+    try:
+        with ThreadPoolExecutor(max_workers=discord.CHANNEL_WORKERS) as executor:
+            list(executor.map(lambda input_file: discord.import_channel(input_file, indexes, did, service, session, guild_uri, tmp_dir, writer), input_files))
+    finally:
+        writer.close()
+
+def run_tunes(playlists, session, service):
+    tunes = load_script('tunes/dreary_tunes.py')
+    index = tunes.TunesIndex(session['did'], service)
+    for playlist_record, tracks in playlists:
+        tunes.mirror_playlist(playlist_record, tracks, index, session, service)
+
+def run_library(data_dir, session, service):
+    # create_book_record without the interactive metadata check
+    library = load_script('library/dreary_library.py')
+    did = session['did']
+    books = []
+    for path in sorted(data_dir.glob('*.pdf')):
+        record = library.create_book_metadata(str(path))
+        record['$type'] = 'dev.dreary.library.book'
+        record['file'] = library.upload_blob(session, service, str(path))
+        record['createdAt'] = library.generate_timestamp()
+        books.append(record)
+    book_uris = apply_writes_batch(session, service, books)
+
+    shelf_uri = library.create_record(session, service, {'$type': 'dev.dreary.library.shelf', 'name': 'bench', 'createdAt': library.generate_timestamp()})
+    shelved = library.build_shelf_index(library.list_records(did, service, 'dev.dreary.library.shelfitem')).get(shelf_uri, set())
+    apply_writes_batch(session, service, [{
+        '$type': 'dev.dreary.library.shelfitem',
+        'book': book_uri,
+        'shelf': shelf_uri,
+        'createdAt': library.generate_timestamp(),
+    } for book_uri in book_uris if book_uri not in shelved])
+
+def run_renpy(data_dir, session, service):
+    # upload_renpy past its prompts
+    renpy = load_script('renpy/atp-renpy.py')
+    project_uri = renpy.create_project_record(session, service, 'bench')
+    records = renpy.draft_asset_records(session, service, str(data_dir), project_uri)
+    renpy.apply_writes_batch(session, service, records)
+
+# name -> (generator, runner, items per size, what an item is)
+WORKLOADS = {
+    'writes': (generate_writes, run_writes, {'small': 1000, 'medium': 10000, 'large': 100000}, 'records'),
+    'discord': (generate_discord, run_discord, {'small': 500, 'medium': 5000, 'large': 50000}, 'messages'),
+    'tunes': (generate_tunes, run_tunes, {'small': 200, 'medium': 2000, 'large': 10000}, 'tracks'),
+    'library': (generate_library, run_library, {'small': 20, 'medium': 200, 'large': 1000}, 'books'),
+    'renpy': (generate_renpy, run_renpy, {'small': 100, 'medium': 1000, 'large': 5000}, 'files'),
+}
+
+def start_mock(args):
+    command = [sys.executable, str(BENCH_DIR / 'mock_pds.py'), '--port', '0', '--latency', str(args.latency),
+               '--rate-limit', str(args.rate_limit), '--rate-window', str(args.rate_window)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    atexit.register(process.terminate)
+    line = process.stdout.readline()
+    if not line.startswith('Mock PDS listening on '):
+        raise Exception(f"Mock PDS failed to start: {line}")
+    return line.split()[-1]
+
+def run(name, size, service, verbose=False):
+    generate, runner, sizes, unit = WORKLOADS[name]
+    items = sizes[size]
+    result = {'workload': name, 'size': size, 'items': items, 'unit': unit}
+    rng = random.Random(f'{name}-{size}')
+
+    with tempfile.TemporaryDirectory(prefix=f'dreary-bench-{name}-') as tmp:
+        try:
+            data = generate(items, Path(tmp), rng)
+        except ModuleNotFoundError as e:
+            result['skipped'] = f'missing {e.name}'
+            return result
+        session = get_session(f'bench-{name}.test', 'password', service)
+        requests.post(f'{service}/_reset').raise_for_status()
+
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            with output:
+                runner(data, session, service)
+        except ModuleNotFoundError as e:
+            result['skipped'] = f'missing {e.name}'
+            return result
+        except Exception as e:
+            result['error'] = f'{type(e).__name__}: {e}'
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    stats = requests.get(f'{service}/_stats').json()
+    result.update({
+        'seconds': round(elapsed, 3),
+        'records': stats['records'],
+        'records_per_sec': round(stats['records'] / elapsed, 1) if elapsed else None,
+        'requests': sum(stats['requests'].values()),
+        'endpoints': stats['requests'],
+        'rate_limited': stats['statuses'].get('429', 0),
+        'bytes_up': stats['bytes_in'],
+        'peak_mib': round(peak / 1024 ** 2, 2),
+    })
+    return result
+
+def print_result(result):
+    label = f"{result['workload']:<8} {result['size']:<6} {result['items']:>7} {result['unit']:<8}"
+    if 'skipped' in result or 'error' in result:
+        print(f"{label} {'skipped' if 'skipped' in result else 'failed'}: {result.get('skipped') or result.get('error')}")
+        return
+    endpoints = ', '.join(f"{nsid.split('.')[-1]}={count}" for nsid, count in sorted(result['endpoints'].items(), key=lambda e: -e[1]))
+    print(f"{label} {result['records']:>7} records {result['seconds']:>8.2f}s {result['records_per_sec']:>9.1f} rec/s "
+          f"{result['requests']:>6} req {result['bytes_up'] / 1024 ** 2:>8.1f} MiB up {result['peak_mib']:>7.1f} MiB peak")
+    if result['rate_limited']:
+        endpoints += f" (429s: {result['rate_limited']})"
+    print(f"{'':<33} {endpoints}")
+
+def regressions(results, baseline, tolerance):
+    # slower, chattier or hungrier than the saved run by more than tolerance
+    previous = {(r['workload'], r['size']): r for r in baseline if 'records' in r}
+    found = []
+    for result in results:
+        if not (before := previous.get((result['workload'], result['size']))):
+            continue
+        label = f"{result['workload']} {result['size']}"
+        if 'error' in result:
+            found.append(f"{label}: {result['error']}")
+            continue
+        if 'records' not in result:
+            continue
+        if result['records_per_sec'] < before['records_per_sec'] * (1 - tolerance):
+            found.append(f"{label}: {result['records_per_sec']} rec/s, was {before['records_per_sec']}")
+        if result['requests'] > before['requests'] * (1 + tolerance):
+            found.append(f"{label}: {result['requests']} requests, was {before['requests']}")
+        if result['peak_mib'] > before['peak_mib'] * (1 + tolerance):
+            found.append(f"{label}: {result['peak_mib']} MiB peak, was {before['peak_mib']}")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the importers against a local mock PDS')
+    parser.add_argument('workloads', nargs='*', metavar='WORKLOAD', help=f"any of {', '.join(WORKLOADS)} (default: all)")
+    parser.add_argument('--sizes', nargs='+', choices=SIZES, default=['small', 'medium'])
+    parser.add_argument('--service', help='use an already running mock PDS instead of starting one')
+    parser.add_argument('--latency', type=float, default=0, help='seconds the mock adds to each request')
+    parser.add_argument('--rate-limit', type=int, default=0, help='mock requests per window, 0 for none')
+    parser.add_argument('--rate-window', type=int, default=60)
+    parser.add_argument('--save', help='write results to this json file')
+    parser.add_argument('--baseline', help='compare against a saved json file, exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression, as a fraction')
+    parser.add_argument('--verbose', action='store_true', help="show the scripts' own output")
+    args = parser.parse_args()
+    if (unknown := set(args.workloads) - WORKLOADS.keys()):
+        parser.error(f"unknown workload(s): {', '.join(sorted(unknown))}")
+
+    service = args.service or start_mock(args)
+    print(f"Benchmarking against {service}")
+
+    results = []
+    for name in args.workloads or WORKLOADS:
+        for size in args.sizes:
+            results.append(run(name, size, service, args.verbose))
+            print_result(results[-1])
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print(f"Regression: {regression}")
+        if found:
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,404 @@
+import argparse
+import base64
+import bisect
+import hashlib
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# a local stand-in for the handful of xrpc endpoints the scripts use, so
+# imports can be run and timed without a real PDS. everything lives in
+# memory and is gone when the process exits. not a PDS: no signing, no
+# repo commits, no lexicon validation, any password works.
+#
+#   python mock_pds.py --port 2583 --latency 0.05 --rate-limit 5000
+#
+# GET /_stats returns request counters, POST /_reset wipes repos and
+# counters between benchmark runs
+
+TID_CHARS = '234567abcdefghijklmnopqrstuvwxyz'
+MAX_WRITES = 200
+MAX_LIMIT = 100
+DEFAULT_LIMIT = 50
+
+
+class XrpcError(Exception):
+    def __init__(self, status, error, message=None, headers=None):
+        super().__init__(message or error)
+        self.status = status
+        self.error = error
+        self.message = message or error
+        self.headers = headers or {}
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def make_jwt(did, scope, ttl):
+    header = b64url(json.dumps({'typ': 'JWT', 'alg': 'none'}).encode())
+    payload = b64url(json.dumps({'sub': did, 'scope': scope, 'iat': int(time.time()), 'exp': int(time.time() + ttl)}).encode())
+    return f'{header}.{payload}.'
+
+def read_jwt(token):
+    try:
+        payload = token.split('.')[1]
+        return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+def make_cid(data, prefix='bafyrei'):
+    # looks like a cid, isn't one. stable per content, which is all the
+    # scripts rely on
+    return prefix + base64.b32encode(hashlib.sha256(data).digest()).decode().lower().rstrip('=')
+
+class Repos:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tid_lock = threading.Lock()
+        # (did, collection) -> {rkey: (cid, value)}, plus sorted rkeys so
+        # listRecords pages don't re-sort the collection
+        self.records = {}
+        self.rkeys = {}
+        self.blobs = {}
+        self.last_tid = 0
+
+    def tid(self):
+        # microsecond clock, strictly increasing like a real TID
+        with self.tid_lock:
+            self.last_tid = max(self.last_tid + 1, time.time_ns() // 1000)
+            value = self.last_tid << 10
+        return ''.join(TID_CHARS[(value >> shift) & 31] for shift in range(60, -1, -5))
+
+    def collection(self, did, collection):
+        key = (did, collection)
+        if key not in self.records:
+            self.records[key] = {}
+            self.rkeys[key] = []
+        return self.records[key], self.rkeys[key]
+
+    def put(self, did, collection, rkey, value, create):
+        records, rkeys = self.collection(did, collection)
+        if create and rkey in records:
+            raise XrpcError(400, 'InvalidRequest', f'Record already exists: {collection}/{rkey}')
+        cid = make_cid(json.dumps(value, sort_keys=True).encode())
+        if rkey not in records:
+            bisect.insort(rkeys, rkey)
+        records[rkey] = (cid, value)
+        return f'at://{did}/{collection}/{rkey}', cid
+
+    def delete(self, did, collection, rkey):
+        records, rkeys = self.collection(did, collection)
+        if records.pop(rkey, None) is not None:
+            del rkeys[bisect.bisect_left(rkeys, rkey)]
+
+    def count(self):
+        return sum(len(records) for records in self.records.values())
+
+class MockPDS:
+    def __init__(self, latency=0, rate_limit=0, rate_window=300, token_ttl=2 * 60 * 60, blob_limit=50 * 1024 * 1024):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.token_ttl = token_ttl
+        self.blob_limit = blob_limit
+        self.stats_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.repos = Repos()
+        with self.stats_lock:
+            self.requests = Counter()
+            self.statuses = Counter()
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.writes = 0
+            self.window_start = time.time()
+            self.window_count = 0
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'requests': dict(self.requests),
+                'statuses': {str(k): v for k, v in self.statuses.items()},
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'writes': self.writes,
+                'records': self.repos.count(),
+                'blobs': len(self.repos.blobs),
+                'blob_bytes': sum(len(data) for data, _ in self.repos.blobs.values()),
+            }
+
+    def rate_limited(self):
+        # fixed window, reported the way the reference PDS does it
+        if not self.rate_limit:
+            return None
+        with self.stats_lock:
+            now = time.time()
+            if now - self.window_start >= self.rate_window:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            remaining = self.rate_limit - self.window_count
+            headers = {
+                'RateLimit-Limit': str(self.rate_limit),
+                'RateLimit-Remaining': str(max(remaining, 0)),
+                'RateLimit-Reset': str(int(self.window_start + self.rate_window)),
+                'RateLimit-Policy': f'{self.rate_limit};w={self.rate_window}',
+            }
+        if remaining < 0:
+            raise XrpcError(429, 'RateLimitExceeded', 'Rate Limit Exceeded', headers)
+        return headers
+
+    def authorize(self, headers, scope='access'):
+        auth = headers.get('Authorization') or ''
+        claims = read_jwt(auth.removeprefix('Bearer '))
+        if not claims or claims.get('scope') != scope:
+            raise XrpcError(401, 'AuthenticationRequired', 'Authentication Required')
+        if claims['exp'] < time.time():
+            raise XrpcError(400, 'ExpiredToken', 'Token has expired')
+        return claims['sub']
+
+    def session(self, did, handle):
+        return {
+            'did': did,
+            'handle': handle,
+            'accessJwt': make_jwt(did, 'access', self.token_ttl),
+            'refreshJwt': make_jwt(did, 'refresh', 90 * 24 * 60 * 60),
+            'active': True,
+        }
+
+    def repo_did(self, did, repo):
+        if repo and repo != did:
+            raise XrpcError(400, 'InvalidRequest', f'Cannot write to {repo} as {did}')
+        return did
+
+    # endpoints
+
+    def create_session(self, params, body, headers):
+        identifier = json.loads(body).get('identifier') or ''
+        if identifier.startswith('did:'):
+            did, handle = identifier, 'mock.test'
+        else:
+            did, handle = f'did:plc:{hashlib.sha256(identifier.encode()).hexdigest()[:24]}', identifier
+        return self.session(did, handle)
+
+    def refresh_session(self, params, body, headers):
+        did = self.authorize(headers, 'refresh')
+        return self.session(did, 'mock.test')
+
+    def create_record(self, params, body, headers):
+        did = self.authorize(headers)
+        payload = json.loads(body)
+        did = self.repo_did(did, payload.get('repo'))
+        record = payload['record']
+        collection = payload.get('collection') or record.get('$type')
+        with self.repos.lock:
+            uri, cid = self.repos.put(did, collection, payload.get('rkey') or self.repos.tid(), record, create=True)
+        with self.stats_lock:
+            self.writes += 1
+        return {'uri': uri, 'cid': cid, 'validationStatus': 'unknown'}
+
+    def apply_writes(self, params, body, headers):
+        did = self.authorize(headers)
+        payload = json.loads(body)
+        did = self.repo_did(did, payload.get('repo'))
+        writes = payload.get('writes') or []
+        if len(writes) > MAX_WRITES:
+            raise XrpcError(400, 'InvalidRequest', f'Too many writes. Max: {MAX_WRITES}')
+
+        results = []
+        with self.repos.lock:
+            # all or nothing, like a single commit
+            for write in writes:
+                kind = write['$type'].split('#')[-1]
+                records, _ = self.repos.collection(did, write['collection'])
+                if kind == 'create' and write.get('rkey') in records:
+                    raise XrpcError(400, 'InvalidRequest', f"Record already exists: {write['collection']}/{write['rkey']}")
+                if kind not in ('create', 'update', 'delete'):
+                    raise XrpcError(400, 'InvalidRequest', f"Unknown write type: {write['$type']}")
+            for write in writes:
+                kind = write['$type'].split('#')[-1]
+                collection = write['collection']
+                if kind == 'delete':
+                    self.repos.delete(did, collection, write['rkey'])
+                    results.append({'$type': 'com.atproto.repo.applyWrites#deleteResult'})
+                    continue
+                rkey = write.get('rkey') or self.repos.tid()
+                uri, cid = self.repos.put(did, collection, rkey, write['value'], create=kind == 'create')
+                results.append({'$type': f'com.atproto.repo.applyWrites#{kind}Result', 'uri': uri, 'cid': cid, 'validationStatus': 'unknown'})
+        with self.stats_lock:
+            self.writes += len(writes)
+        return {'commit': {'cid': make_cid(body), 'rev': self.repos.tid()}, 'results': results}
+
+    def get_record(self, params, body, headers):
+        did, collection, rkey = params.get('repo'), params.get('collection'), params.get('rkey')
+        with self.repos.lock:
+            records, _ = self.repos.collection(did, collection)
+            if not (found := records.get(rkey)):
+                raise XrpcError(400, 'RecordNotFound', f'Could not locate record: at://{did}/{collection}/{rkey}')
+        cid, value = found
+        return {'uri': f'at://{did}/{collection}/{rkey}', 'cid': cid, 'value': value}
+
+    def list_records(self, params, body, headers):
+        did, collection = params.get('repo'), params.get('collection')
+        limit = min(max(int(params.get('limit') or DEFAULT_LIMIT), 1), MAX_LIMIT)
+        cursor = params.get('cursor')
+        reverse = params.get('reverse') == 'true'
+        with self.repos.lock:
+            records, rkeys = self.repos.collection(did, collection)
+            # newest (highest rkey) first unless reversed
+            if reverse:
+                start = bisect.bisect_right(rkeys, cursor) if cursor else 0
+                page = rkeys[start:start + limit]
+            else:
+                end = bisect.bisect_left(rkeys, cursor) if cursor else len(rkeys)
+                page = rkeys[max(end - limit, 0):end][::-1]
+            page = [(rkey, *records[rkey]) for rkey in page]
+        response = {'records': [{'uri': f'at://{did}/{collection}/{rkey}', 'cid': cid, 'value': value} for rkey, cid, value in page]}
+        if page:
+            response['cursor'] = page[-1][0]
+        return response
+
+    def upload_blob(self, params, body, headers):
+        self.authorize(headers)
+        if len(body) > self.blob_limit:
+            raise XrpcError(400, 'BlobTooLarge', f'This file is too large. It is {len(body)} bytes but the maximum size is {self.blob_limit} bytes.')
+        mimetype = headers.get('Content-Type') or 'application/octet-stream'
+        cid = make_cid(body, 'bafkrei')
+        with self.repos.lock:
+            self.repos.blobs[cid] = (body, mimetype)
+        return {'blob': {'$type': 'blob', 'ref': {'$link': cid}, 'mimeType': mimetype, 'size': len(body)}}
+
+    def get_blob(self, params, body, headers):
+        with self.repos.lock:
+            if not (blob := self.repos.blobs.get(params.get('cid'))):
+                raise XrpcError(400, 'BlobNotFound', 'Blob not found')
+        return blob
+
+    def describe_repo(self, params, body, headers):
+        did = params.get('repo')
+        with self.repos.lock:
+            collections = sorted({collection for repo, collection in self.repos.records if repo == did})
+        return {'did': did, 'handle': 'mock.test', 'collections': collections, 'handleIsCorrect': True}
+
+ENDPOINTS = {
+    'com.atproto.server.createSession': ('POST', MockPDS.create_session),
+    'com.atproto.server.refreshSession': ('POST', MockPDS.refresh_session),
+    'com.atproto.repo.createRecord': ('POST', MockPDS.create_record),
+    'com.atproto.repo.applyWrites': ('POST', MockPDS.apply_writes),
+    'com.atproto.repo.uploadBlob': ('POST', MockPDS.upload_blob),
+    'com.atproto.repo.getRecord': ('GET', MockPDS.get_record),
+    'com.atproto.repo.listRecords': ('GET', MockPDS.list_records),
+    'com.atproto.repo.describeRepo': ('GET', MockPDS.describe_repo),
+    'com.atproto.sync.getBlob': ('GET', MockPDS.get_blob),
+}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    pds = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while (size := int(self.rfile.readline().split(b';')[0], 16)):
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            self.rfile.readline()
+            return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def send(self, status, body, content_type='application/json', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        with self.pds.stats_lock:
+            self.pds.statuses[status] += 1
+            self.pds.bytes_out += len(body)
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        body = self.read_body() if method == 'POST' else b''
+
+        if url.path == '/_stats':
+            return self.send(200, self.pds.stats())
+        if url.path == '/_reset':
+            self.pds.reset()
+            return self.send(200, {})
+
+        nsid = url.path.removeprefix('/xrpc/')
+        with self.pds.stats_lock:
+            self.pds.requests[nsid] += 1
+            self.pds.bytes_in += len(body)
+        if self.pds.latency:
+            time.sleep(self.pds.latency)
+
+        rate_headers = None
+        try:
+            if not (endpoint := ENDPOINTS.get(nsid)):
+                raise XrpcError(501, 'MethodNotImplemented', f'Method Not Implemented: {nsid}')
+            if endpoint[0] != method:
+                raise XrpcError(405, 'InvalidRequest', f'Incorrect HTTP method ({method}) expected {endpoint[0]}')
+            rate_headers = self.pds.rate_limited()
+            result = endpoint[1](self.pds, params, body, self.headers)
+        except XrpcError as e:
+            return self.send(e.status, {'error': e.error, 'message': e.message}, headers={**(rate_headers or {}), **e.headers})
+        except (KeyError, TypeError, ValueError) as e:
+            return self.send(400, {'error': 'InvalidRequest', 'message': f'Invalid request: {e!r}'}, headers=rate_headers)
+
+        if isinstance(result, tuple):
+            data, mimetype = result
+            return self.send(200, data, mimetype, rate_headers)
+        self.send(200, result, headers=rate_headers)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+def serve(pds, host='127.0.0.1', port=0):
+    handler = type('BoundHandler', (Handler,), {'pds': pds})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Run an in-memory mock PDS')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2583, help='0 picks a free port')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every xrpc request')
+    parser.add_argument('--rate-limit', type=int, default=0, help='requests per window before 429s, 0 for none')
+    parser.add_argument('--rate-window', type=int, default=300, help='rate limit window in seconds')
+    parser.add_argument('--token-ttl', type=int, default=2 * 60 * 60, help='access token lifetime in seconds')
+    parser.add_argument('--blob-limit', type=int, default=50 * 1024 * 1024, help='max uploadBlob size in bytes')
+    args = parser.parse_args()
+
+    pds = MockPDS(args.latency, args.rate_limit, args.rate_window, args.token_ttl, args.blob_limit)
+    server = serve(pds, args.host, args.port)
+    # the benchmark reads this line to find the port
+    print(f'Mock PDS listening on http://{args.host}:{server.server_port}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
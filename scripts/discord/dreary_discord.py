@@ -1,6 +1,40 @@
 from bsky_utils import *
+import argparse
+import hashlib
 import sys
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from dreary_common import stats
+from dreary_common.blobs import upload_blob_stream
+from dreary_common.config import login
+from dreary_common.http_cache import cached_download, cached_get
+from dreary_common.images import prepare_image
+from dreary_common.rkeys import RkeyIndex
+from dreary_common.writes import WriteScheduler, create_write
+
+# a discord cdn path names one upload (ids and asset hashes), so a cached
+# copy stays good. the ex/is/hm query parameters are a signature that
+# expires and changes between exports, so they're left out of cache keys
+CDN_CACHE_TTL = 30 * 24 * 60 * 60
+CDN_SIGNATURE_PARAMS = {'ex', 'is', 'hm'}
+ASSET_WORKERS = 8
+# attachments are the big transfers, keep fewer of them in flight
+ATTACHMENT_WORKERS = 4
+CHANNEL_WORKERS = 4
+
+index_lock = threading.Lock()
+# (index key, rkey) -> Claim for dependencies a channel is still drafting
+claims = {}
+
+class Claim:
+    def __init__(self):
+        self.done = threading.Event()
+        self.failed = False
 
 def safe_delete_tmp_dir(tmp_dir, base_dir):
     try:
@@ -14,11 +48,16 @@ def safe_delete_tmp_dir(tmp_dir, base_dir):
     except Exception as e:
         print(f"Error deleting {tmp_dir}: {e}")
 
+def cdn_cache_key(url):
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in CDN_SIGNATURE_PARAMS]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
 def retrieve_json_str(url, base_dir):
     if not url.startswith('https://'):
         with open(base_dir / url, "r", encoding="utf-8") as f:
             return f.read()
-    response = requests.get(url)
+    response = cached_get(url, ttl=CDN_CACHE_TTL, key=cdn_cache_key(url))
     response.raise_for_status()
     return response.text
 
@@ -26,16 +65,16 @@ def retrieve_blob_path(url, base_dir, tmp_dir):
     if not url.startswith('https://'):
         return str(base_dir / url)
 
-    filepath = tmp_dir / url.split("/")[-1].split("?")[0]
-
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
-
-    with open(filepath, "wb") as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
+    # prefixed so same-named files from different urls can't collide when
+    # several downloads run at once
+    key = cdn_cache_key(url)
+    name = url.split("/")[-1].split("?")[0]
+    filepath = tmp_dir / f'{hashlib.sha256(key.encode()).hexdigest()[:12]}-{name}'
+    return cached_download(url, filepath, ttl=CDN_CACHE_TTL, key=key)
 
-    return filepath
+def retrieve_image_path(url, base_dir, tmp_dir):
+    # downscaled/recompressed copy when the image pipeline is enabled
+    return prepare_image(retrieve_blob_path(url, base_dir, tmp_dir))
     
 
 def find_or_create_channel(channel, did, service, session, guild_uri):
@@ -64,9 +103,9 @@ def find_or_create_guild(guild, did, service, session, base_dir, tmp_dir):
     if not (icon_path := guild.get('iconUrl')):
         raise Exception("Missing necessary guild field: iconUrl")
 
-    blob_location = retrieve_blob_path(icon_path, base_dir, tmp_dir)
+    blob_location = retrieve_image_path(icon_path, base_dir, tmp_dir)
     blob = upload_blob(session, service, blob_location)
-    if blob["mimeType"].split('/')[0] != "image":
+    if (blob_type := blob["mimeType"]).split('/')[0] != "image":
         raise Exception(f"Unsupported blob type '{blob_type}'")
     record = {
         '$type': 'dev.dreary.discord.guild',
@@ -76,19 +115,16 @@ def find_or_create_guild(guild, did, service, session, base_dir, tmp_dir):
     return create_record(session, service, record, rkey=guild['id'])
 
 
-def find_or_create_author(author, eauth_index, did, service, session, base_dir, tmp_dir):
-    if author['id'] in eauth_index:
-        return compose_uri(did, author['id'], collection='dev.dreary.discord.author')
-
+def draft_author_record(author, session, service, base_dir, tmp_dir):
     if not (avatar_path := author.get('avatarUrl')):
         raise Exception("Missing necessary author field: avatarUrl")
 
-    blob_location = retrieve_blob_path(avatar_path, base_dir, tmp_dir)
+    blob_location = retrieve_image_path(avatar_path, base_dir, tmp_dir)
     blob = upload_blob(session, service, blob_location)
-    if blob["mimeType"].split('/')[0] != "image":
+    if (blob_type := blob["mimeType"]).split('/')[0] != "image":
         raise Exception(f"Unsupported blob type '{blob_type}'")
-    
-    record = {
+
+    return {
         '$type': 'dev.dreary.discord.author',
         'name': author['name'],
         'discriminator': author.get('discriminator'),
@@ -98,12 +134,8 @@ def find_or_create_author(author, eauth_index, did, service, session, base_dir,
         'roles': author.get('roles'),
         'avatar': blob
     }
-    return create_record(session, service, record, rkey=author['id'])
-
-def find_or_create_sticker(sticker, esticker_index, did, service, session, base_dir, tmp_dir):
-    if sticker['id'] in esticker_index:
-        return compose_uri(did, sticker['id'], collection='dev.dreary.discord.sticker')
 
+def draft_sticker_record(sticker, session, service, base_dir, tmp_dir):
     if not (sticker_path := sticker.get('sourceUrl')):
         raise Exception("Missing necessary sticker field: sourceUrl")
 
@@ -111,20 +143,219 @@ def find_or_create_sticker(sticker, esticker_index, did, service, session, base_
         '$type': 'dev.dreary.discord.sticker',
         'name': sticker['name'],
         'format': sticker['format'],
-        'source': retrieve_json_str(sticker_path, base_dir)
     }
-    return create_record(session, service, record, rkey=sticker['id'])
+    # lottie stickers are json animations, the rest are images
+    if str(sticker['format']).lower() == 'lottie':
+        record['source'] = retrieve_json_str(sticker_path, base_dir)
+    else:
+        record['image'] = upload_blob(session, service, retrieve_image_path(sticker_path, base_dir, tmp_dir))
+    return record
 
+def draft_embed_record(embed, session, service, base_dir, tmp_dir):
+    # embeds are kept as exported, there's no stable id to key them on
+    return {'$type': 'dev.dreary.discord.embed', **embed}
 
+def draft_emoji_record(emoji, session, service, base_dir, tmp_dir):
+    record = {
+        '$type': 'dev.dreary.discord.emoji',
+        'name': emoji.get('name'),
+        'code': emoji.get('code'),
+        'isAnimated': emoji.get('isAnimated'),
+    }
+    if (image_path := emoji.get('imageUrl')):
+        record['image'] = upload_blob(session, service, retrieve_image_path(image_path, base_dir, tmp_dir))
+    return record
+
+def draft_attachment_record(attachment, session, service, base_dir, tmp_dir):
+    # streamed straight from the export folder or the cdn into uploadBlob
+    source = attachment['url']
+    if not source.startswith('https://'):
+        source = str(base_dir / source)
+    record = {
+        '$type': 'dev.dreary.discord.attachment',
+        'fileName': attachment.get('fileName'),
+        'fileSizeBytes': attachment.get('fileSizeBytes'),
+    }
+    if (blob := upload_blob_stream(session, service, source, size=attachment.get('fileSizeBytes'))):
+        record['file'] = blob
+    else:
+        # keep the metadata so the message still points at something
+        print(f"Attachment {attachment['id']} is over the blob limit, storing without file")
+        record['url'] = attachment['url'] if attachment['url'].startswith('https://') else None
+    return record
+
+def embed_rkey(embed):
+    # identical embeds (the same link posted twice) share one record
+    return hashlib.sha256(json.dumps(embed, sort_keys=True).encode()).hexdigest()[:32]
+
+def emoji_rkey(emoji):
+    # custom emoji have snowflakes, unicode ones only their codepoints
+    if emoji.get('id'):
+        return emoji['id']
+    return 'u' + '-'.join(f'{ord(c):x}' for c in emoji.get('name') or '')
+
+# index key -> (record drafter, how many may draft at once)
+DEPENDENCIES = {
+    'author': (draft_author_record, ASSET_WORKERS),
+    'sticker': (draft_sticker_record, ASSET_WORKERS),
+    'embed': (draft_embed_record, ASSET_WORKERS),
+    'emoji': (draft_emoji_record, ASSET_WORKERS),
+    'attachment': (draft_attachment_record, ATTACHMENT_WORKERS),
+}
+
+def collect_dependencies(messages, indexes):
+    # one pass over the export for every distinct thing messages point at
+    found = {key: {} for key in DEPENDENCIES}
+    for message in messages:
+        if message['id'] in indexes['message']:
+            continue
+        found['author'].setdefault(message['author']['id'], message['author'])
+        for mention in message.get('mentions') or []:
+            found['author'].setdefault(mention['id'], mention)
+        for sticker in message.get('stickers') or []:
+            found['sticker'].setdefault(sticker['id'], sticker)
+        for embed in message.get('embeds') or []:
+            found['embed'].setdefault(embed_rkey(embed), embed)
+        for reaction in message.get('reactions') or []:
+            found['emoji'].setdefault(emoji_rkey(reaction['emoji']), reaction['emoji'])
+        for attachment in message.get('attachments') or []:
+            found['attachment'].setdefault(attachment['id'], attachment)
+    return found
+
+def claim_missing(indexes, key, rkeys, track=False):
+    # channels import concurrently against the same indexes. whoever claims
+    # an rkey first creates it. tracked claims stay pending until settled,
+    # and other channels wait on them before pointing messages there
+    with index_lock:
+        missing = indexes[key].missing(rkeys)
+        indexes[key].update(missing)
+        if track:
+            for rkey in missing:
+                claims[key, rkey] = Claim()
+    return missing
+
+def settle_claims(indexes, key, rkeys, failed=False):
+    # a failed rkey leaves the index so a later channel can try it again,
+    # and whoever was waiting on it fails instead of referencing nothing
+    with index_lock:
+        for rkey in rkeys:
+            if failed:
+                indexes[key].discard(rkey)
+            if (claim := claims.pop((key, rkey), None)):
+                claim.failed = failed
+                claim.done.set()
+
+def wait_for_claims(found, writer):
+    with index_lock:
+        pending = [(key, rkey, claim) for key in DEPENDENCIES for rkey in found[key] if (claim := claims.get((key, rkey)))]
+    for key, rkey, claim in pending:
+        # once a write has failed nothing more goes out, so don't wait on
+        # a claim that may never be settled
+        while not claim.done.wait(1):
+            if writer.error:
+                raise writer.error
+        if claim.failed:
+            raise Exception(f"{key} {rkey} failed to import in another channel")
+
+def create_dependencies(found, indexes, did, service, session, base_dir, tmp_dir, writer):
+    for key, (drafter, workers) in DEPENDENCIES.items():
+        if not (missing := claim_missing(indexes, key, found[key], track=True)):
+            continue
+        print(f"Creating {len(missing)} {key} record(s)")
+        try:
+            # drafting is where the avatar/sticker/emoji fetches and uploads
+            # happen, so those run side by side. each asset is fetched once
+            # per id, and the http cache keeps cdn copies across runs
+            with stats.phase('assets'), ThreadPoolExecutor(max_workers=workers) as executor:
+                records = executor.map(lambda rkey: drafter(found[key][rkey], session, service, base_dir, tmp_dir), missing)
+                writes = [create_write(record, rkey) for rkey, record in zip(missing, records)]
+            # submit re-raises an earlier batch's failure
+            writer.submit(writes)
+        except BaseException:
+            settle_claims(indexes, key, missing, failed=True)
+            raise
+        settle_claims(indexes, key, missing)
+    # this channel's own claims are settled by now, so waiting on other
+    # channels' can't deadlock
+    wait_for_claims(found, writer)
+
+@stats.phase('index load')
 def populate_indexes(did, service):
+    # rkeys only, uris are composed when a message references one
     indexes = {}
-    for rtype in ['author', 'message', 'sticker', 'embed', 'attachment']: # 'channel', 'guild'
-        existing_records = list_records(did, service, f'dev.dreary.discord.{rtype}')
-        indexes[rtype] = {decompose_uri(uri)[2]: uri for record in existing_records if (uri := record['uri'])}
+    for rtype in ['author', 'message', 'sticker', 'embed', 'emoji', 'attachment']: # 'channel', 'guild'
+        indexes[rtype] = RkeyIndex.load(did, service, f'dev.dreary.discord.{rtype}')
         print(f'{rtype} index loaded')
     return indexes
 
-def find_or_create_messages(messages, indexes, did, service, session, guild_uri, channel_uri, base_dir, tmp_dir):
+def draft_message_record(message, indexes, did, guild_uri, channel_uri):
+    # every reference resolves with an index lookup, the pre-pass has
+    # already created whatever was missing
+    # TODO: reaction emojis (particularly if svg files don't work), authors, custom emotes?
+    # TODO: embeds, attachments, stickers
+    # TODO: some things shouldn't be lexicons? like reactions, probably stickers, attachments, embeds too? it doesn't really matter if they have an id, i can include it anyways 
+    # alternatively i could replace just the values i want in the original message, 
+    # which has the advantage of automatically accomodating unexpected fields
+    # this also has the disadvantage of automatically accomodating unexpected fields
+    record = {
+        '$type': 'dev.dreary.discord.message',
+        'type': message['type'],
+        'timestamp': convert_timestamp_utc(message['timestamp']),
+        'timestampEdited': message.get('timestampEdited'),
+        # 'channelIndex': i, # timestamp is probably cannonical
+        'callEndedTimestamp': message.get('callEndedTimestamp'),
+        'isPinned': message.get('isPinned'),
+        'content': message['content'],
+        'author': indexes['author'][message['author']['id']],
+        'guild': guild_uri,
+        'channel': channel_uri
+    }
+
+    if ref := message.get('reference'):
+        record['reference'] = {
+            'message': f"at://{did}/dev.dreary.discord.message/{ref.get('messageId')}",
+            'channel': f"at://{did}/dev.dreary.discord.channel/{ref.get('channelId')}",
+            'guild': f"at://{did}/dev.dreary.discord.guild/{ref.get('guildId') or '0'}",
+        }
+
+    # for mention in message.get('mentions'):
+    #     record['mentions'] = []
+    #     author_uri = find_or_create_author(mention, indexes['author'], did, service, session, base_dir, tmp_dir)
+    #     record['mentions'].append(author_uri)
+    #     indexes['author'][decompose_uri(author_uri)[2]] = author_uri
+    # for sticker in message.get('stickers'):
+    #     record['stickers'] = []
+    #     sticker_uri = find_or_create_sticker(sticker, embed_index, did, service, session, base_dir, tmp_dir)
+    #     record['stickers'].append(sticker_uri)
+    #     indexes['sticker'][decompose_uri(sticker_uri)[2]] = sticker_uri
+    # for embed in message.get('embeds'):
+    #     record['embeds'] = []
+    #     embed_uri = find_or_create_embed(embed, embed_index, did, service, session, base_dir, tmp_dir)
+    #     record['embeds'].append(embed_uri)
+    #     indexes['embed'][decompose_uri(embed_uri)[2]] = embed_uri
+    # for reaction in message.get('reactions'):
+    #     record['reactions'] = []
+    #     reaction_uri = find_or_create_reaction(reaction, embed_index, did, service, session, base_dir, tmp_dir)
+    #     record['reactions'].append(reaction_uri)
+    #     indexes['reaction'][decompose_uri(reaction_uri)[2]] = reaction_uri
+
+    if (mentions := message.get('mentions')):
+        record['mentions'] = [indexes['author'][mention['id']] for mention in mentions]
+    if (stickers := message.get('stickers')):
+        record['stickers'] = [indexes['sticker'][sticker['id']] for sticker in stickers]
+    if (embeds := message.get('embeds')):
+        record['embeds'] = [indexes['embed'][embed_rkey(embed)] for embed in embeds]
+    if (attachments := message.get('attachments')):
+        record['attachments'] = [indexes['attachment'][attachment['id']] for attachment in attachments]
+    if (reactions := message.get('reactions')):
+        record['reactions'] = [{
+            'emoji': indexes['emoji'][emoji_rkey(reaction['emoji'])],
+            'count': reaction.get('count'),
+        } for reaction in reactions]
+
+    return record
+
+def find_or_create_messages(messages, indexes, did, service, session, guild_uri, channel_uri, base_dir, tmp_dir, writer):
     # existing_authors = list_records(did, service, 'dev.dreary.discord.author')
     # eauth_index = {decompose_uri(uri)[2]: uri for eauth in existing_authors if (uri := eauth['uri'])}
     # print("Author index loaded")
@@ -133,119 +364,87 @@ def find_or_create_messages(messages, indexes, did, service, session, guild_uri,
     # print("Message index loaded")
     # TODO: switch to applywrites
     # for i, message in enumerate(messages):
-    for message in messages:
-        # at small scale it's more efficient to list_records rather than request each time
-        # if get_record(did, 'dev.dreary.discord.message', message['id'], service, fatal=False):
-        #     continue
-        if message['id'] in indexes['message']:
-            print(f"Skipping existing message: {message['id']}")
-            continue
-        # TODO: reaction emojis (particularly if svg files don't work), authors, custom emotes?
-        # TODO: embeds, attachments, stickers
-        # TODO: some things shouldn't be lexicons? like reactions, probably stickers, attachments, embeds too? it doesn't really matter if they have an id, i can include it anyways 
-        author_uri = find_or_create_author(message['author'], indexes['author'], did, service, session, base_dir, tmp_dir)
-        indexes['author'][decompose_uri(author_uri)[2]] = author_uri
-        # alternatively i could replace just the values i want in the original message, 
-        # which has the advantage of automatically accomodating unexpected fields
-        # this also has the disadvantage of automatically accomodating unexpected fields
-        record = {
-            '$type': 'dev.dreary.discord.message',
-            'type': message['type'],
-            'timestamp': convert_timestamp_utc(message['timestamp']),
-            'timestampEdited': message.get('timestampEdited'),
-            # 'channelIndex': i, # timestamp is probably cannonical
-            'callEndedTimestamp': message.get('callEndedTimestamp'),
-            'isPinned': message.get('isPinned'),
-            'content': message['content'],
-            'author': author_uri,
-            'guild': guild_uri,
-            'channel': channel_uri
-        }
+    # at small scale it's more efficient to list_records rather than request each time
+    # if get_record(did, 'dev.dreary.discord.message', message['id'], service, fatal=False):
+    #     continue
+    found = collect_dependencies(messages, indexes)
+    create_dependencies(found, indexes, did, service, session, base_dir, tmp_dir, writer)
+
+    new_ids = set(claim_missing(indexes, 'message', [message['id'] for message in messages]))
+    if skipped := len(messages) - len(new_ids):
+        print(f"Skipping {skipped} existing message(s)")
+    writer.submit(
+        create_write(draft_message_record(message, indexes, did, guild_uri, channel_uri), message['id'])
+        for message in messages if message['id'] in new_ids
+    )
+
+def load_export(input_file):
+    try:
+        with open(input_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except:
+        raise Exception(f"Input a valid JSON file path: {input_file}")
 
-        if ref := message.get('reference'):
-            record['reference'] = {}
-            record['reference']['message'] = compose_uri(did, ref.get('messageId'), collection='dev.dreary.discord.message')
-            record['reference']['channel'] = compose_uri(did, ref.get('channelId'), collection='dev.dreary.discord.channel')
-            record['reference']['guild'] = compose_uri(did, ref.get('guildId') or "0", collection='dev.dreary.discord.guild')
-        
-        field_configs = [
-            ('mentions', 'author', find_or_create_author),
-            ('stickers', 'sticker', find_or_create_sticker),
-            ('embeds', 'embed', find_or_create_embed),
-            ('reactions', 'reaction', find_or_create_reaction),
-        ]
-
-        for msg_field, index_key, creator_func in field_configs:
-            if not (items := message.get(msg_field)):
-                continue
-            record[msg_field] = []
-            for item in items:
-                uri = creator_func(item, indexes[index_key], did, service, session, base_dir, tmp_dir)
-                record[msg_field].append(uri)
-                indexes[index_key][decompose_uri(uri)[2]] = uri
-
-        # for mention in message.get('mentions'):
-        #     record['mentions'] = []
-        #     author_uri = find_or_create_author(mention, indexes['author'], did, service, session, base_dir, tmp_dir)
-        #     record['mentions'].append(author_uri)
-        #     indexes['author'][decompose_uri(author_uri)[2]] = author_uri
-        # for sticker in message.get('stickers'):
-        #     record['stickers'] = []
-        #     sticker_uri = find_or_create_sticker(sticker, embed_index, did, service, session, base_dir, tmp_dir)
-        #     record['stickers'].append(sticker_uri)
-        #     indexes['sticker'][decompose_uri(sticker_uri)[2]] = sticker_uri
-        # for embed in message.get('embeds'):
-        #     record['embeds'] = []
-        #     embed_uri = find_or_create_embed(embed, embed_index, did, service, session, base_dir, tmp_dir)
-        #     record['embeds'].append(embed_uri)
-        #     indexes['embed'][decompose_uri(embed_uri)[2]] = embed_uri
-        # for reaction in message.get('reactions'):
-        #     record['reactions'] = []
-        #     reaction_uri = find_or_create_reaction(reaction, embed_index, did, service, session, base_dir, tmp_dir)
-        #     record['reactions'].append(reaction_uri)
-        #     indexes['reaction'][decompose_uri(reaction_uri)[2]] = reaction_uri
-
-        create_record(session, service, record, rkey=message['id'])
-
-def main():
-    with open('../../config.json') as f:
-        config = json.load(f)
-    HANDLE = config.get('HANDLE')
-    PASSWORD = config.get('PASSWORD')
-    if not (HANDLE and PASSWORD):
-        print('Enter credentials in config.json')
+def import_channel(input_file, indexes, did, service, session, guild_uri, tmp_dir, writer):
+    data = load_export(input_file)
+    print(f"Importing #{data['channel']['name']} ({len(data['messages'])} messages)")
+    channel_uri = find_or_create_channel(data['channel'], did, service, session, guild_uri)
+    find_or_create_messages(data['messages'], indexes, did, service, session, guild_uri, channel_uri, input_file.parent, tmp_dir, writer)
+    return data['channel']['name']
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Import DiscordChatExporter JSON exports as dev.dreary.discord records.")
+    parser.add_argument('input', nargs='?', help="an export file, or a directory of a guild's channel exports")
+    args = parser.parse_args(argv)
+    stats.start('dreary_discord')
+    did, service, session = login()
+    if not session:
         return
-    
-    did = resolve_handle(HANDLE)
-    service = get_service_endpoint(did)
-    session = get_session(did, PASSWORD, service)
 
-    if len(sys.argv) < 2:
-        input_file = input('Input an input file: ')
-        if input_file == '': return
+    if not (input_path := args.input):
+        input_path = input('Input an export file or directory: ')
+        if input_path == '': return
+
+    # a directory is a whole guild: every channel export in it shares one
+    # index load and one write scheduler
+    input_path = Path(input_path)
+    if input_path.is_dir():
+        base_dir = input_path
+        input_files = sorted(input_path.glob('*.json'))
+        if not input_files:
+            raise Exception(f"No JSON exports found in {input_path}")
     else:
-        input_file = sys.argv[1]
-
-    input_file = Path(input_file)
-    base_dir = input_file.parent
-
-    try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-    except:
-        raise Exception("Input a valid JSON file path")
+        base_dir = input_path.parent
+        input_files = [input_path]
 
     tmp_dir = base_dir / f'tmp-{generate_timestamp()}'
     tmp_dir.mkdir(parents=True, exist_ok=True)
 
-    guild_uri = find_or_create_guild(data['guild'], did, service, session, base_dir, tmp_dir)
-    channel_uri = find_or_create_channel(data['channel'], did, service, session, guild_uri)
-    indexes = populate_indexes(did, service)
-    find_or_create_messages(data['messages'], indexes, did, service, session, guild_uri, channel_uri, base_dir, tmp_dir)
-
-    print('All done importing :3')
-    safe_delete_tmp_dir(tmp_dir, base_dir)
-
+    failed = []
+    try:
+        guild = load_export(input_files[0])['guild']
+        guild_uri = find_or_create_guild(guild, did, service, session, base_dir, tmp_dir)
+        indexes = populate_indexes(did, service)
+
+        writer = WriteScheduler(session, service)
+        try:
+            with ThreadPoolExecutor(max_workers=CHANNEL_WORKERS) as executor:
+                futures = {executor.submit(import_channel, input_file, indexes, did, service, session, guild_uri, tmp_dir, writer): input_file for input_file in input_files}
+                for future in as_completed(futures):
+                    try:
+                        print(f"Finished #{future.result()}")
+                    except Exception as e:
+                        print(f"Failed to import {futures[future]}: {e}")
+                        failed.append(futures[future])
+        finally:
+            writer.close()
+    finally:
+        safe_delete_tmp_dir(tmp_dir, base_dir)
+
+    if failed:
+        print(f"{len(failed)} export(s) failed: {', '.join(str(f) for f in failed)}")
+    else:
+        print('All done importing :3')
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,65 @@
+import argparse
+import importlib.util
+import sys
+from pathlib import Path
+
+# one entry point for every importer. nothing heavier than argparse is
+# imported until a subcommand runs, and then only that script (and
+# whatever its code path needs) gets loaded, so `dreary --help` stays
+# instant. each script parses its own arguments and still runs on its own.
+#   python dreary.py tunes --batch playlists.txt
+#   python dreary.py discord exports/guild
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+
+# subcommand -> (script, help)
+COMMANDS = {
+    'tunes': ('tunes/dreary_tunes.py', "mirror YouTube, SoundCloud, Bandcamp and Spotify playlists"),
+    'spotify': ('tunes/spotify.py', "mirror a Spotify playlist, album or track, or bulk import tracks"),
+    'discord': ('discord/dreary_discord.py', "import DiscordChatExporter exports"),
+    'library': ('library/dreary_library.py', "create library books and shelves"),
+    'renpy': ('renpy/atp-renpy.py', "upload or download a Ren'Py game"),
+    'purge': ('purge.py', "delete records from a dev.dreary.* collection, optionally filtered"),
+}
+
+
+def load_script(relpath):
+    # the scripts aren't packages (and atp-renpy has a dash in it), so load
+    # them by path with their own directory importable for siblings
+    path = SCRIPTS_DIR / relpath
+    name = path.stem.replace('-', '_')
+    if name in sys.modules:
+        return sys.modules[name]
+    if str(path.parent) not in sys.path:
+        sys.path.insert(0, str(path.parent))
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # registered first so sibling imports (spotify -> dreary_tunes) reuse it
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='dreary', description="Import things into dev.dreary.* records on your PDS.")
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    for command, (_, help) in COMMANDS.items():
+        # options belong to the script, which parses them itself
+        commands.add_parser(command, help=help, add_help=False)
+    args, rest = parser.parse_known_args(argv)
+    if not args.command:
+        parser.print_help()
+        return 2
+
+    try:
+        script = load_script(COMMANDS[args.command][0])
+    except ModuleNotFoundError as e:
+        print(f"dreary {args.command}: {e}", file=sys.stderr)
+        return 1
+    script.main(rest, prog=f'dreary {args.command}')
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2 @@
+# shared helpers for the dreary scripts. kept free of bsky_utils so the
+# standalone scripts (atp-renpy) can use them too.
@@ -0,0 +1,102 @@
+import hashlib
+import mimetypes
+import os
+import threading
+
+import requests
+
+from . import stats
+
+# PDS blob upload limit. the reference PDS is configurable
+# (PDS_BLOB_UPLOAD_LIMIT), so this is too
+MAX_BLOB_BYTES = int(os.getenv('DREARY_BLOB_LIMIT') or 50 * 1024 * 1024)
+CHUNK_SIZE = 64 * 1024
+
+lock = threading.Lock()
+# content hash / source url -> blob ref, for this run. blobs that no record
+# references get garbage collected by the PDS, so this isn't persisted
+uploaded = {}
+
+
+class HashingReader:
+    # file-like over a stream that hashes what passes through it. __len__
+    # lets requests send a Content-Length instead of chunked encoding
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+        self.sha256 = hashlib.sha256()
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        chunk = self.stream.read(CHUNK_SIZE if size is None or size < 0 else size)
+        self.sha256.update(chunk)
+        return chunk
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def post_blob(session, service, body, mimetype):
+    response = requests.post(
+        f"{service}/xrpc/com.atproto.repo.uploadBlob",
+        headers={
+            "Content-Type": mimetype,
+            "Authorization": f"Bearer {session['accessJwt']}",
+        },
+        data=body,
+    )
+    if not response.ok:
+        print(f"Request failed. Status code: {response.status_code}. Response: {response.text}")
+    response.raise_for_status()
+    return response.json().get('blob')
+
+def remember(*keys, blob):
+    with lock:
+        for key in keys:
+            uploaded[key] = blob
+
+@stats.phase('blob upload')
+def upload_blob_stream(session, service, source, size=None, mimetype=None):
+    # uploads a local file or an https url without staging it anywhere.
+    # returns None when the blob is over the PDS limit
+    mimetype = mimetype or mimetypes.guess_type(source.split('?')[0])[0] or 'application/octet-stream'
+
+    if not source.startswith('https://'):
+        size = os.path.getsize(source)
+        if size > MAX_BLOB_BYTES:
+            return None
+        digest = file_sha256(source)
+        if (blob := uploaded.get(digest)):
+            return blob
+        with open(source, 'rb') as f:
+            blob = post_blob(session, service, HashingReader(f, size), mimetype)
+        remember(digest, blob=blob)
+        return blob
+
+    if (blob := uploaded.get(source)):
+        return blob
+    if size is not None and size > MAX_BLOB_BYTES:
+        return None
+    # identity encoding so the raw stream is the file itself
+    with requests.get(source, stream=True, headers={'Accept-Encoding': 'identity'}) as response:
+        response.raise_for_status()
+        size = int(response.headers.get('content-length') or size or 0)
+        if size > MAX_BLOB_BYTES:
+            return None
+        if not size:
+            # no length to stream against, fall back to buffering it
+            body = response.content
+            if len(body) > MAX_BLOB_BYTES:
+                return None
+            blob = post_blob(session, service, body, mimetype)
+            remember(source, hashlib.sha256(body).hexdigest(), blob=blob)
+            return blob
+        reader = HashingReader(response.raw, size)
+        blob = post_blob(session, service, reader, mimetype)
+    remember(source, reader.sha256.hexdigest(), blob=blob)
+    return blob
@@ -0,0 +1,28 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+CACHE_DIR = Path(os.getenv('DREARY_CACHE_DIR') or Path(os.getenv('XDG_CACHE_HOME') or Path.home() / '.cache') / 'dreary')
+
+
+def cache_path(name):
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    return CACHE_DIR / name
+
+def load_cache(name, default=None):
+    try:
+        with open(cache_path(name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+def save_cache(name, data):
+    # write then rename so a killed run never leaves half a file behind.
+    # these can hold tokens, so keep them private
+    path = cache_path(name)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}-{threading.get_ident()}.tmp')
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
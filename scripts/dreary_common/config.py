@@ -0,0 +1,38 @@
+import json
+import os
+from pathlib import Path
+
+# config.json at the repo root, shared by every script. DREARY_CONFIG
+# points somewhere else. HANDLE and PASSWORD can also come from the
+# environment, which is how atp-renpy's .env gets them.
+CONFIG_PATH = Path(os.getenv('DREARY_CONFIG') or Path(__file__).resolve().parents[2] / 'config.json')
+
+config = None
+
+
+def load_config():
+    global config
+    if config is None:
+        try:
+            with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            config = {}
+    return config
+
+def credentials():
+    config = load_config()
+    return config.get('HANDLE') or os.getenv('HANDLE'), config.get('PASSWORD') or os.getenv('PASSWORD')
+
+def login():
+    # identity pulls in requests, only needed once a command actually logs in
+    from .identity import get_service_endpoint, get_session, resolve_handle
+    handle, password = credentials()
+    if not (handle and password):
+        print(f'Enter credentials in {CONFIG_PATH}')
+        return None, None, None
+
+    did = resolve_handle(handle)
+    service = get_service_endpoint(did)
+    session = get_session(did, password, service)
+    return did, service, session
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from . import stats
+from .cache import CACHE_DIR
+
+# a disk cache for GETs of pages, api responses and cdn files that get
+# re-fetched every time an import is re-run or resumed. entries younger
+# than their ttl are served without a request, older ones are revalidated
+# with If-None-Match/If-Modified-Since, and the least recently used are
+# evicted once the cache grows past its size budget.
+HTTP_CACHE_DIR = CACHE_DIR / 'http'
+ENABLED = os.getenv('DREARY_HTTP_CACHE', '1') != '0'
+# overrides every caller's ttl when set
+TTL_OVERRIDE = int(ttl) if (ttl := os.getenv('DREARY_HTTP_CACHE_TTL')) else None
+MAX_BYTES = int(os.getenv('DREARY_HTTP_CACHE_BYTES') or 1024 ** 3)
+EVICT_EVERY = 50
+
+lock = threading.Lock()
+stores_since_evict = EVICT_EVERY
+
+
+def entry_paths(key):
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return HTTP_CACHE_DIR / f'{digest}.json', HTTP_CACHE_DIR / f'{digest}.body'
+
+def load_entry(key):
+    meta_path, body_path = entry_paths(key)
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None, body_path
+    if not body_path.exists():
+        return None, body_path
+    return meta, body_path
+
+def atomic_write(path, data, mode='w'):
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}-{threading.get_ident()}.tmp')
+    with open(tmp_path, mode, **({} if 'b' in mode else {'encoding': 'utf-8'})) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def store_entry(key, url, response):
+    global stores_since_evict
+    HTTP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    meta_path, body_path = entry_paths(key)
+    atomic_write(body_path, response.content, 'wb')
+    atomic_write(meta_path, json.dumps({
+        'url': url,
+        'status': response.status_code,
+        'headers': {k.lower(): v for k, v in response.headers.items() if k.lower() in ('content-type', 'etag', 'last-modified')},
+        'encoding': response.encoding,
+        'fetched': time.time(),
+    }))
+    with lock:
+        stores_since_evict += 1
+        if stores_since_evict < EVICT_EVERY:
+            return
+        stores_since_evict = 0
+    evict()
+
+def touch(meta_path, meta=None):
+    # meta mtime doubles as the lru clock
+    if meta is not None:
+        atomic_write(meta_path, json.dumps(meta))
+    else:
+        os.utime(meta_path)
+
+def evict(max_bytes=None):
+    max_bytes = max_bytes or MAX_BYTES
+    entries = []
+    total = 0
+    for meta_path in HTTP_CACHE_DIR.glob('*.json'):
+        body_path = meta_path.with_suffix('.body')
+        try:
+            size = meta_path.stat().st_size + body_path.stat().st_size
+            entries.append((meta_path.stat().st_mtime, size, meta_path, body_path))
+        except FileNotFoundError:
+            continue
+        total += size
+    if total <= max_bytes:
+        return
+    # trim to 90% so the next few stores don't trigger another scan
+    for _, size, meta_path, body_path in sorted(entries):
+        if total <= max_bytes * 0.9:
+            break
+        for path in (meta_path, body_path):
+            path.unlink(missing_ok=True)
+        total -= size
+
+def cached_response(url, meta, body_path):
+    response = requests.Response()
+    response.status_code = meta['status']
+    response.headers = CaseInsensitiveDict(meta['headers'])
+    response.encoding = meta.get('encoding')
+    response.url = url
+    with open(body_path, 'rb') as f:
+        response._content = f.read()
+    return response
+
+def cached_get(url, headers=None, ttl=24 * 60 * 60, session=None, key=None):
+    # key defaults to the url; headers (auth tokens etc) never go in it
+    http = session or requests
+    if not ENABLED:
+        return http.get(url, headers=headers)
+
+    key = key or url
+    ttl = TTL_OVERRIDE if TTL_OVERRIDE is not None else ttl
+    meta, body_path = load_entry(key)
+    meta_path = entry_paths(key)[0]
+    if meta and time.time() - meta['fetched'] < ttl:
+        touch(meta_path)
+        stats.incr('http cache hits')
+        return cached_response(url, meta, body_path)
+
+    headers = dict(headers or {})
+    if meta:
+        if (etag := meta['headers'].get('etag')):
+            headers['If-None-Match'] = etag
+        if (modified := meta['headers'].get('last-modified')):
+            headers['If-Modified-Since'] = modified
+
+    response = http.get(url, headers=headers)
+    if response.status_code == 304 and meta:
+        meta['fetched'] = time.time()
+        touch(meta_path, meta)
+        stats.incr('http cache revalidations')
+        return cached_response(url, meta, body_path)
+    if response.status_code == 200:
+        store_entry(key, url, response)
+    return response
+
+def cached_download(url, path, ttl=24 * 60 * 60, session=None, key=None):
+    # copies the cached body to path so callers keep their own file names
+    # (upload helpers sniff the mime type from the extension)
+    if not ENABLED:
+        response = (session or requests).get(url)
+        response.raise_for_status()
+        with open(path, 'wb') as f:
+            f.write(response.content)
+        return path
+    response = cached_get(url, ttl=ttl, session=session, key=key)
+    response.raise_for_status()
+    meta, body_path = load_entry(key or url)
+    if meta:
+        shutil.copyfile(body_path, path)
+    else:
+        with open(path, 'wb') as f:
+            f.write(response.content)
+    return path
@@ -0,0 +1,131 @@
+import base64
+import json
+import threading
+import time
+
+import requests
+
+from . import stats
+from .cache import load_cache, save_cache
+
+# handles and PDS endpoints rarely move, a day is plenty fresh
+HANDLE_TTL = 24 * 60 * 60
+SERVICE_TTL = 24 * 60 * 60
+# treat a jwt as expired this long before it actually is
+TOKEN_MARGIN = 5 * 60
+
+IDENTITY_CACHE = 'identity.json'
+SESSION_CACHE = 'sessions.json'
+
+lock = threading.Lock()
+
+
+def get_json(url):
+    response = requests.get(url)
+    if not response.ok:
+        print(f"Request failed. Status code: {response.status_code}. Response: {response.text}")
+    response.raise_for_status()
+    return response.json()
+
+def post_json(url, token=None, payload=None):
+    headers = {'Authorization': f'Bearer {token}'} if token else {}
+    response = requests.post(url, headers=headers, json=payload)
+    if not response.ok:
+        print(f"Request failed. Status code: {response.status_code}. Response: {response.text}")
+    response.raise_for_status()
+    return response.json()
+
+def cached_lookup(section, key, ttl, fetch):
+    with lock:
+        cache = load_cache(IDENTITY_CACHE) or {}
+        if (entry := cache.get(section, {}).get(key)) and time.time() - entry['at'] < ttl:
+            return entry['value']
+    value = fetch()
+    if value:
+        with lock:
+            cache = load_cache(IDENTITY_CACHE) or {}
+            cache.setdefault(section, {})[key] = {'value': value, 'at': time.time()}
+            save_cache(IDENTITY_CACHE, cache)
+    return value
+
+@stats.phase('identity')
+def resolve_handle(handle):
+    if handle.startswith("did:"):
+        return handle
+    if handle.startswith("@"):
+        handle = handle[1:]
+    if not handle:
+        return None
+    url = f'https://public.api.bsky.app/xrpc/com.atproto.identity.resolveHandle?handle={handle}'
+    return cached_lookup('handles', handle.lower(), HANDLE_TTL, lambda: (get_json(url) or {}).get('did'))
+
+def get_did_doc(did):
+    if did.startswith('did:web:'):
+        url = f'https://{did[8:]}/.well-known/did.json'
+    else:
+        url = f'https://plc.directory/{did}'
+    return get_json(url)
+
+def fetch_service_endpoint(did):
+    for service in (get_did_doc(did).get('service') or []):
+        if service.get('type') == 'AtprotoPersonalDataServer':
+            return service.get('serviceEndpoint')
+    return None
+
+@stats.phase('identity')
+def get_service_endpoint(did):
+    return cached_lookup('services', did, SERVICE_TTL, lambda: fetch_service_endpoint(did))
+
+def forget_identity(did):
+    # call when a cached endpoint turns out to be wrong, e.g. after a migration
+    with lock:
+        cache = load_cache(IDENTITY_CACHE) or {}
+        cache.get('services', {}).pop(did, None)
+        save_cache(IDENTITY_CACHE, cache)
+
+def jwt_expiry(token):
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get('exp') or 0
+    except (AttributeError, IndexError, ValueError):
+        return 0
+
+def token_valid(token):
+    return bool(token) and jwt_expiry(token) - TOKEN_MARGIN > time.time()
+
+def store_session(key, session):
+    with lock:
+        sessions = load_cache(SESSION_CACHE) or {}
+        sessions[key] = session
+        save_cache(SESSION_CACHE, sessions)
+
+def refresh_session(session, service_endpoint):
+    # updates the session dict in place so everything holding it picks up
+    # the new tokens
+    url = f'{service_endpoint}/xrpc/com.atproto.server.refreshSession'
+    session.update(post_json(url, token=session.get('refreshJwt')))
+    store_session(f"{session.get('did')} {service_endpoint}", session)
+    return session
+
+@stats.phase('identity')
+def get_session(username, password, service_endpoint):
+    key = f'{username} {service_endpoint}'
+    with lock:
+        session = (load_cache(SESSION_CACHE) or {}).get(key)
+
+    if session and token_valid(session.get('accessJwt')):
+        return session
+    if session and token_valid(session.get('refreshJwt')):
+        try:
+            return refresh_session(session, service_endpoint)
+        except requests.exceptions.HTTPError:
+            print("Session refresh failed, creating a new session")
+
+    url = f'{service_endpoint}/xrpc/com.atproto.server.createSession'
+    session = post_json(url, payload={
+        'identifier': username,
+        'password': password,
+    })
+    store_session(key, session)
+    return session
@@ -0,0 +1,130 @@
+import atexit
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from . import stats
+from .cache import CACHE_DIR
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# optional: shrink images to MAX_DIMENSION and re-encode them as webp/jpeg
+# when that comes out smaller, before they're uploaded as blobs. off unless
+# Pillow is installed and DREARY_IMAGE_MAX_DIMENSION is set. encoding is
+# cpu bound, so it runs in a process pool, and results are cached by the
+# source's hash so re-runs don't redo the work.
+MAX_DIMENSION = int(os.getenv('DREARY_IMAGE_MAX_DIMENSION') or 0)
+QUALITY = int(os.getenv('DREARY_IMAGE_QUALITY') or 85)
+ENABLED = Image is not None and MAX_DIMENSION > 0
+IMAGE_CACHE_DIR = CACHE_DIR / 'images'
+SOURCE_FORMATS = {'PNG', 'JPEG', 'WEBP', 'BMP', 'TIFF'}
+SUFFIXES = {'PNG': '.png', 'JPEG': '.jpg', 'WEBP': '.webp'}
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            # the first image usually shows up on a worker thread, and
+            # forking while other threads hold locks can deadlock the
+            # children, so they're started by a forkserver (spawn where
+            # there's none) instead
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context(method))
+            atexit.register(pool.shutdown)
+        return pool
+
+def encode(image, image_format, path, lossless):
+    if image_format == 'PNG':
+        image.save(path, 'PNG', optimize=True)
+    elif image_format == 'JPEG':
+        image.convert('RGB').save(path, 'JPEG', quality=QUALITY, optimize=True, progressive=True)
+    else:
+        image.save(path, 'WEBP', lossless=lossless, quality=QUALITY if not lossless else 100, method=6)
+
+def optimize(source, target_stem, max_dimension, keep_format):
+    # runs in a worker process. returns the smallest encoding's path, or
+    # None when nothing beat the original
+    with Image.open(source) as image:
+        if image.format not in SOURCE_FORMATS or getattr(image, 'is_animated', False):
+            return None
+        source_format = image.format
+        image.load()
+        resized = False
+        if not keep_format and max(image.size) > max_dimension:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            resized = True
+
+        if keep_format:
+            candidates = [source_format] if source_format in SUFFIXES else []
+        else:
+            has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+            # jpeg would flatten transparency
+            candidates = ['WEBP'] + ([] if has_alpha else ['JPEG'])
+            if resized and source_format in SUFFIXES:
+                candidates.append(source_format)
+
+        # candidates are encoded under temp names and only the winner is
+        # moved into place, so the cache never shows a half-written or
+        # losing file under `<key>.<ext>`
+        best = best_format = None
+        best_size = os.path.getsize(source)
+        for image_format in dict.fromkeys(candidates):
+            path = f'{target_stem}{SUFFIXES[image_format]}.{os.getpid()}-{threading.get_ident()}.tmp'
+            try:
+                encode(image, image_format, path, lossless=keep_format)
+                size = os.path.getsize(path)
+            except Exception:
+                for stale in (path, best):
+                    if stale and os.path.exists(stale):
+                        os.remove(stale)
+                raise
+            # a resize has to go out even if it happens to be larger
+            if size < best_size or (resized and best is None):
+                if best:
+                    os.remove(best)
+                best, best_format, best_size = path, image_format, size
+            else:
+                os.remove(path)
+        if best is None:
+            return None
+        target = f'{target_stem}{SUFFIXES[best_format]}'
+        os.replace(best, target)
+        return target
+
+@stats.phase('images')
+def prepare_image(path, keep_format=False):
+    # returns a path to upload in place of `path`: the cached optimized
+    # copy when there is one, otherwise the original. keep_format only
+    # recompresses losslessly in the same format and never resizes, for
+    # files whose name and dimensions matter (game assets)
+    if not ENABLED:
+        return path
+    path = str(path)
+    with open(path, 'rb') as f:
+        digest = hashlib.file_digest(f, 'sha256').hexdigest()
+    key = f"{digest}-{'keep' if keep_format else MAX_DIMENSION}-{QUALITY}"
+    IMAGE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+    # .tmp files are another process's candidates still being encoded
+    if (cached := next((p for p in IMAGE_CACHE_DIR.glob(f'{key}.*') if p.suffix != '.tmp'), None)):
+        return path if cached.suffix == '.skip' else str(cached)
+
+    try:
+        result = get_pool().submit(optimize, path, str(IMAGE_CACHE_DIR / key), MAX_DIMENSION, keep_format).result()
+    except Exception as e:
+        # not an image pillow understands; upload it untouched
+        print(f"Image optimization skipped for {path}: {e}")
+        result = None
+    if result is None:
+        (IMAGE_CACHE_DIR / f'{key}.skip').touch()
+        return path
+    return result
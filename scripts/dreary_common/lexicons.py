@@ -0,0 +1,402 @@
+import hashlib
+import importlib.util
+import json
+import marshal
+import os
+import re
+import threading
+import time
+import unicodedata
+from pathlib import Path
+
+from . import stats
+from .cache import CACHE_DIR
+
+# pre-flight record validation against lexicons/dev/dreary. each lexicon is
+# compiled once into plain python (one function per def, straight-line
+# isinstance/len checks, no schema walking at validation time) and the code
+# object is cached on disk keyed by the schema's hash. records that fail
+# are quarantined to a jsonl file instead of failing a whole applyWrites
+# batch on the PDS.
+#
+# the lexicons are hand-written and loose, so the compiler is forgiving:
+# the nsid comes from the file path rather than the "id" field, "int"
+# means integer, objects may list their properties inline without a
+# "properties" key, and anything it doesn't understand is accepted. null
+# counts as an absent field, since the scripts write None for missing
+# optional data. DREARY_VALIDATE=0 turns validation off.
+LEXICON_DIR = Path(os.getenv('DREARY_LEXICON_DIR') or Path(__file__).resolve().parents[2] / 'lexicons')
+ENABLED = os.getenv('DREARY_VALIDATE', '1') != '0'
+COMPILED_DIR = CACHE_DIR / 'lexicons'
+QUARANTINE_DIR = CACHE_DIR / 'quarantine'
+# bump when the generated code changes shape
+COMPILER_VERSION = 1
+
+FORMATS = {
+    'datetime': re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})$').match,
+    'at-uri': re.compile(r'^at://[^\s/?#]+(/[^\s/?#]+(/[^\s/?#]+)?)?$').match,
+    'did': re.compile(r'^did:[a-z]+:[a-zA-Z0-9._:%-]*[a-zA-Z0-9._-]$').match,
+    'handle': re.compile(r'^([a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?$').match,
+    'nsid': re.compile(r'^[a-zA-Z]([a-zA-Z0-9-]{0,62})?(\.[a-zA-Z0-9]([a-zA-Z0-9-]{0,62})?)+$').match,
+    'uri': re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*:\S+$').match,
+    'cid': re.compile(r'^[a-zA-Z0-9+=]{8,256}$').match,
+    'tid': re.compile(r'^[234567abcdefghij][234567abcdefghijklmnopqrstuvwxyz]{12}$').match,
+    'record-key': re.compile(r'^(?!\.{1,2}$)[a-zA-Z0-9_~.:-]{1,512}$').match,
+    'language': re.compile(r'^[a-zA-Z]{1,8}(-[a-zA-Z0-9]{1,8})*$').match,
+}
+OBJECT_KEYWORDS = {'type', 'description', 'required', 'nullable', 'properties'}
+
+lock = threading.Lock()
+quarantine_lock = threading.Lock()
+lexicons = None
+compiled = {}
+
+
+def graphemes(text):
+    # close enough without a grapheme segmenter: combining marks, variation
+    # selectors and zwj-joined characters don't start a new grapheme
+    count = 0
+    joined = False
+    for char in text:
+        if joined or unicodedata.combining(char) or '\ufe00' <= char <= '\ufe0f' or '\U0001f3fb' <= char <= '\U0001f3ff':
+            joined = False
+            continue
+        if char == '\u200d':
+            joined = True
+            continue
+        count += 1
+    return count
+
+def mime_accepted(mimetype, patterns):
+    for pattern in patterns:
+        if pattern == '*/*' or pattern == mimetype or (pattern.endswith('/*') and mimetype.startswith(pattern[:-1])):
+            return True
+    return False
+
+def noop(value, path, errors):
+    pass
+
+def properties_of(schema):
+    properties = schema.get('properties')
+    if isinstance(properties, dict):
+        return properties
+    return {k: v for k, v in schema.items() if k not in OBJECT_KEYWORDS and isinstance(v, dict)}
+
+def func_name(def_name):
+    return 'def_' + re.sub(r'\W', '_', def_name)
+
+class Compiler:
+    def __init__(self, nsid, doc):
+        self.nsid = nsid
+        self.defs = {name: schema for name, schema in (doc.get('defs') or {}).items() if isinstance(schema, dict)}
+        self.lines = []
+        self.formats = set()
+        self.counter = 0
+
+    def var(self):
+        self.counter += 1
+        return f'v{self.counter}'
+
+    def emit(self, depth, line):
+        self.lines.append('    ' * depth + line)
+
+    def error(self, depth, path, message):
+        self.emit(depth, f'errors.append({path} + {" " + message!r})')
+
+    def compile(self):
+        for def_name, schema in self.defs.items():
+            if schema.get('type') == 'record':
+                schema = schema.get('record') or {}
+            elif schema.get('type') in ('query', 'procedure', 'subscription', 'params', 'permission-set'):
+                continue
+            self.emit(0, f'def {func_name(def_name)}(v, path, errors):')
+            if not self.value(schema, 'v', 'path', 1):
+                self.emit(1, 'pass')
+        header = [f'F_{name.replace("-", "_")} = FORMATS[{name!r}]' for name in sorted(self.formats)]
+        return '\n'.join(header + self.lines) + '\n'
+
+    def schema_type(self, schema):
+        kind = schema.get('type')
+        if kind == 'int':
+            return 'integer'
+        if kind is None and schema and all(isinstance(v, dict) for k, v in schema.items() if k not in OBJECT_KEYWORDS):
+            # an object written as a bare map of its properties
+            return 'object'
+        return kind
+
+    def value(self, schema, var, path, depth):
+        # emits checks for `var` and returns whether anything was emitted
+        mark = len(self.lines)
+        handler = getattr(self, f"compile_{(self.schema_type(schema) or '').replace('-', '_')}", None)
+        if handler:
+            handler(schema, var, path, depth)
+        return len(self.lines) > mark
+
+    def guarded(self, depth, condition, path, message, checks):
+        # type check, then the constraint checks in an else branch
+        self.emit(depth, f'if {condition}:')
+        self.error(depth + 1, path, message)
+        mark = len(self.lines)
+        self.emit(depth, 'else:')
+        checks(depth + 1)
+        if len(self.lines) == mark + 1:
+            del self.lines[mark:]
+
+    def compile_object(self, schema, var, path, depth):
+        properties = properties_of(schema)
+        required = [key for key in schema.get('required') or [] if isinstance(key, str)]
+
+        def checks(depth):
+            for key in required:
+                self.emit(depth, f'if {var}.get({key!r}) is None:')
+                self.error(depth + 1, path, f'is missing required field {key!r}')
+            for key, prop in properties.items():
+                if not isinstance(prop, dict):
+                    continue
+                child = self.var()
+                mark = len(self.lines)
+                self.emit(depth, f'{child} = {var}.get({key!r})')
+                self.emit(depth, f'if {child} is not None:')
+                if not self.value(prop, child, f'{path} + {"." + key!r}', depth + 1):
+                    del self.lines[mark:]
+        self.guarded(depth, f'not isinstance({var}, dict)', path, 'must be an object', checks)
+
+    def compile_string(self, schema, var, path, depth):
+        def checks(depth):
+            # lengths are utf-8 bytes; only encode when the length in
+            # characters leaves it in doubt
+            if isinstance(n := schema.get('maxLength'), int):
+                self.emit(depth, f'if len({var}) > {n // 4} and len({var}.encode()) > {n}:')
+                self.error(depth + 1, path, f'must be at most {n} bytes')
+            if isinstance(n := schema.get('minLength'), int) and n > 0:
+                self.emit(depth, f'if len({var}) < {n} and len({var}.encode()) < {n}:')
+                self.error(depth + 1, path, f'must be at least {n} bytes')
+            if isinstance(n := schema.get('maxGraphemes'), int):
+                self.emit(depth, f'if len({var}) > {n} and graphemes({var}) > {n}:')
+                self.error(depth + 1, path, f'must be at most {n} graphemes')
+            if isinstance(n := schema.get('minGraphemes'), int) and n > 0:
+                self.emit(depth, f'if graphemes({var}) < {n}:')
+                self.error(depth + 1, path, f'must be at least {n} graphemes')
+            if isinstance(enum := schema.get('enum'), list):
+                self.emit(depth, f'if {var} not in {frozenset(enum)!r}:')
+                self.error(depth + 1, path, f'must be one of {sorted(enum)}')
+            if isinstance(const := schema.get('const'), str):
+                self.emit(depth, f'if {var} != {const!r}:')
+                self.error(depth + 1, path, f'must be {const!r}')
+            if (fmt := schema.get('format')) in FORMATS:
+                self.formats.add(fmt)
+                self.emit(depth, f'if not F_{fmt.replace("-", "_")}({var}):')
+                self.error(depth + 1, path, f'must be a valid {fmt}')
+        self.guarded(depth, f'not isinstance({var}, str)', path, 'must be a string', checks)
+
+    def compile_integer(self, schema, var, path, depth):
+        def checks(depth):
+            if isinstance(n := schema.get('minimum'), int):
+                self.emit(depth, f'if {var} < {n}:')
+                self.error(depth + 1, path, f'must be at least {n}')
+            if isinstance(n := schema.get('maximum'), int):
+                self.emit(depth, f'if {var} > {n}:')
+                self.error(depth + 1, path, f'must be at most {n}')
+            if isinstance(enum := schema.get('enum'), list):
+                self.emit(depth, f'if {var} not in {frozenset(enum)!r}:')
+                self.error(depth + 1, path, f'must be one of {sorted(enum)}')
+            if isinstance(const := schema.get('const'), int):
+                self.emit(depth, f'if {var} != {const!r}:')
+                self.error(depth + 1, path, f'must be {const}')
+        # bool is an int subclass, so compare types exactly
+        self.guarded(depth, f'type({var}) is not int', path, 'must be an integer', checks)
+
+    def compile_boolean(self, schema, var, path, depth):
+        def checks(depth):
+            if isinstance(const := schema.get('const'), bool):
+                self.emit(depth, f'if {var} is not {const!r}:')
+                self.error(depth + 1, path, f'must be {str(const).lower()}')
+        self.guarded(depth, f'type({var}) is not bool', path, 'must be a boolean', checks)
+
+    def compile_array(self, schema, var, path, depth):
+        def checks(depth):
+            if isinstance(n := schema.get('maxLength'), int):
+                self.emit(depth, f'if len({var}) > {n}:')
+                self.error(depth + 1, path, f'must have at most {n} items')
+            if isinstance(n := schema.get('minLength'), int) and n > 0:
+                self.emit(depth, f'if len({var}) < {n}:')
+                self.error(depth + 1, path, f'must have at least {n} items')
+            if isinstance(items := schema.get('items'), dict):
+                index, item = self.var(), self.var()
+                mark = len(self.lines)
+                self.emit(depth, f'for {index}, {item} in enumerate({var}):')
+                self.emit(depth + 1, f'if {item} is not None:')
+                if not self.value(items, item, f"{path} + f'[{{{index}}}]'", depth + 2):
+                    del self.lines[mark:]
+        self.guarded(depth, f'not isinstance({var}, list)', path, 'must be an array', checks)
+
+    def compile_blob(self, schema, var, path, depth):
+        def checks(depth):
+            if isinstance(accept := schema.get('accept'), list):
+                self.emit(depth, f"if not mime_accepted({var}.get('mimeType') or '', {tuple(accept)!r}):")
+                self.error(depth + 1, path, f'mime type must match one of {accept}')
+            if isinstance(n := schema.get('maxSize'), int):
+                self.emit(depth, f"if ({var}.get('size') or 0) > {n}:")
+                self.error(depth + 1, path, f'must be at most {n} bytes')
+        # legacy blobs are {cid, mimeType} without a $type
+        self.guarded(depth, f"not isinstance({var}, dict) or ({var}.get('$type') != 'blob' and 'cid' not in {var})", path, 'must be a blob', checks)
+
+    def compile_cid_link(self, schema, var, path, depth):
+        self.emit(depth, f"if not isinstance({var}, dict) or not isinstance({var}.get('$link'), str):")
+        self.error(depth + 1, path, 'must be a cid link')
+
+    def compile_bytes(self, schema, var, path, depth):
+        self.emit(depth, f"if not isinstance({var}, dict) or not isinstance({var}.get('$bytes'), str):")
+        self.error(depth + 1, path, 'must be bytes')
+
+    def compile_unknown(self, schema, var, path, depth):
+        self.emit(depth, f'if not isinstance({var}, dict):')
+        self.error(depth + 1, path, 'must be an object')
+
+    def call(self, ref, var, path, depth):
+        ref = self.qualify(ref)
+        nsid, _, name = ref.partition('#')
+        if nsid == self.nsid:
+            if name in self.defs:
+                self.emit(depth, f'{func_name(name)}({var}, {path}, errors)')
+        else:
+            self.emit(depth, f'resolve({ref!r})({var}, {path}, errors)')
+
+    def qualify(self, ref):
+        ref = f'{self.nsid}{ref}' if ref.startswith('#') else ref
+        return ref if '#' in ref else f'{ref}#main'
+
+    def compile_ref(self, schema, var, path, depth):
+        if isinstance(ref := schema.get('ref'), str):
+            self.call(ref, var, path, depth)
+
+    def compile_union(self, schema, var, path, depth):
+        refs = [self.qualify(ref) for ref in schema.get('refs') or [] if isinstance(ref, str)]
+
+        def checks(depth):
+            kind = self.var()
+            self.emit(depth, f"{kind} = {var}['$type']")
+            self.emit(depth, f"{kind} = {kind} if '#' in {kind} else {kind} + '#main'")
+            for i, ref in enumerate(refs):
+                self.emit(depth, f"{'if' if i == 0 else 'elif'} {kind} == {ref!r}:")
+                mark = len(self.lines)
+                self.call(ref, var, path, depth + 1)
+                if len(self.lines) == mark:
+                    self.emit(depth + 1, 'pass')
+            if schema.get('closed'):
+                self.emit(depth, 'else:' if refs else 'if True:')
+                self.error(depth + 1, path, f'must be one of {refs}')
+        self.guarded(depth, f"not isinstance({var}, dict) or not isinstance({var}.get('$type'), str)", path, 'must be an object with a $type', checks)
+
+def load_lexicons(root=LEXICON_DIR):
+    # nsid -> lexicon document. empty and unparseable files are skipped
+    docs = {}
+    for path in sorted(Path(root).rglob('*.json')):
+        nsid = '.'.join(path.relative_to(root).with_suffix('').parts)
+        try:
+            text = path.read_text(encoding='utf-8')
+            if text.strip():
+                docs[nsid] = json.loads(text)
+        except (OSError, ValueError) as e:
+            print(f"Skipping unreadable lexicon {path}: {e}")
+    return docs
+
+def compile_lexicon(nsid, doc):
+    source_hash = hashlib.sha256(json.dumps([COMPILER_VERSION, nsid, doc], sort_keys=True).encode()).hexdigest()
+    # code objects are only good for the interpreter that made them
+    cache_path = COMPILED_DIR / f'{source_hash[:32]}-{importlib.util.MAGIC_NUMBER.hex()}.bin'
+    try:
+        with open(cache_path, 'rb') as f:
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    code = compile(Compiler(nsid, doc).compile(), f'<lexicon {nsid}>', 'exec')
+    COMPILED_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}-{threading.get_ident()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        marshal.dump(code, f)
+    os.replace(tmp_path, cache_path)
+    return code
+
+def get_lexicons():
+    global lexicons
+    if lexicons is None:
+        lexicons = load_lexicons()
+    return lexicons
+
+def definitions(nsid):
+    with lock:
+        if nsid in compiled:
+            return compiled[nsid]
+        if (doc := get_lexicons().get(nsid)) is None:
+            compiled[nsid] = None
+            return None
+        namespace = {
+            'FORMATS': FORMATS,
+            'graphemes': graphemes,
+            'mime_accepted': mime_accepted,
+            'resolve': resolve,
+        }
+        exec(compile_lexicon(nsid, doc), namespace)
+        compiled[nsid] = namespace
+        return namespace
+
+def resolve(ref):
+    nsid, _, name = ref.partition('#')
+    namespace = definitions(nsid)
+    return (namespace or {}).get(func_name(name or 'main'), noop)
+
+def get_validator(nsid):
+    # returns validate(record) -> [errors], or None when there's no lexicon
+    namespace = definitions(nsid)
+    if not namespace or not (main := namespace.get('def_main')):
+        return None
+    def validate(record):
+        errors = []
+        main(record, nsid, errors)
+        return errors
+    return validate
+
+def validate_record(record):
+    validator = get_validator(record.get('$type', '').split('#')[0])
+    return validator(record) if validator else []
+
+def quarantine(write, errors):
+    collection = write.get('collection') or 'unknown'
+    QUARANTINE_DIR.mkdir(parents=True, exist_ok=True)
+    path = QUARANTINE_DIR / f'{collection}.jsonl'
+    entry = {
+        'at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'collection': collection,
+        'rkey': write.get('rkey'),
+        'errors': errors,
+        'value': write.get('value'),
+    }
+    with quarantine_lock:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, default=str) + '\n')
+    stats.incr('quarantined')
+    print(f"Quarantined invalid {collection} record ({'; '.join(errors[:3])}), see {path}")
+
+def screen_writes(writes):
+    # one flag per write; False means it failed validation and was
+    # quarantined. deletes and collections without a lexicon always pass
+    if not ENABLED:
+        return [True] * len(writes)
+    validators = {}
+    flags = []
+    for write in writes:
+        value = write.get('value')
+        if value is None:
+            flags.append(True)
+            continue
+        collection = write.get('collection')
+        if collection not in validators:
+            validators[collection] = get_validator(collection)
+        if (validator := validators[collection]) and (errors := validator(value)):
+            quarantine(write, errors)
+            flags.append(False)
+        else:
+            flags.append(True)
+    return flags
@@ -0,0 +1,141 @@
+import keyword
+import sys
+import threading
+import time
+
+import requests
+
+from . import stats
+from .lexicons import get_lexicons, properties_of
+from .writes import MAX_RETRIES, RETRY_STATUSES, retry_delay
+
+# compact in-memory stand-ins for listRecords results. a class is generated
+# per collection from its lexicon with __slots__ for just the fields an
+# index needs, and listing pages are parsed straight into instances, so
+# the cid, the unused fields and two dicts per record are never kept.
+# at-uri and did fields are interned: every playlistitem repeats its
+# playlist's uri. records written back from these (to_value) only carry
+# the kept fields, so keep everything the lexicon defines for anything
+# that gets updated.
+
+PAGE_SIZE = 100
+INTERNED_FORMATS = {'at-uri', 'did'}
+
+lock = threading.Lock()
+classes = {}
+
+
+def lexicon_fields(nsid):
+    # top-level record properties across the lexicon and its older
+    # versions (`<name>-v0.json` and so on)
+    fields = {}
+    for name, doc in get_lexicons().items():
+        if name != nsid and not name.startswith(f'{nsid}-v'):
+            continue
+        main = (doc.get('defs') or {}).get('main') or {}
+        for field, schema in properties_of(main.get('record') or {}).items():
+            if isinstance(schema, dict):
+                fields.setdefault(field, schema)
+    return fields
+
+def intern_str(value):
+    return sys.intern(value) if type(value) is str else value
+
+def class_source(class_name, nsid, fields, interned):
+    args = ''.join(f', {field}=None' for field in fields)
+    lines = [
+        f'class {class_name}:',
+        f'    __slots__ = {("uri", *fields)!r}',
+        f'    nsid = {nsid!r}',
+        f'    fields = {tuple(fields)!r}',
+        '',
+        f'    def __init__(self, uri=None{args}):',
+        '        self.uri = uri',
+        *(f'        self.{field} = {field}' for field in fields),
+        '',
+        '    @classmethod',
+        '    def from_value(cls, uri, value):',
+        '        get = value.get',
+        '        return cls(intern_str(uri)' + ''.join(
+            f", intern_str(get({field!r}))" if field in interned else f", get({field!r})" for field in fields) + ')',
+        '',
+        '    @classmethod',
+        '    def from_record(cls, record):',
+        "        return cls.from_value(record['uri'], record.get('value') or {})",
+        '',
+        '    def to_value(self):',
+        f'        value = {{"$type": {nsid!r}}}',
+        *(line for field in fields for line in (
+            f'        if self.{field} is not None:',
+            f'            value[{field!r}] = self.{field}',
+        )),
+        '        return value',
+        '',
+        '    def __repr__(self):',
+        f"        return f'{class_name}(uri={{self.uri!r}}" + ''.join(f", {field}={{self.{field}!r}}" for field in fields) + ")'",
+    ]
+    return '\n'.join(lines) + '\n'
+
+def record_class(nsid, fields):
+    # fields are checked against the lexicon so a typo fails at import
+    # rather than silently reading None for every record
+    fields = tuple(fields)
+    with lock:
+        if (cls := classes.get((nsid, fields))):
+            return cls
+        known = lexicon_fields(nsid)
+        if known and (unknown := [field for field in fields if field not in known]):
+            raise ValueError(f"{nsid} has no field(s) {', '.join(unknown)}")
+        if (bad := [field for field in fields if not field.isidentifier() or keyword.iskeyword(field)]):
+            raise ValueError(f"Can't store {', '.join(bad)} as attributes")
+        interned = {field for field in fields if known.get(field, {}).get('format') in INTERNED_FORMATS}
+        class_name = ''.join(part[:1].upper() + part[1:] for part in nsid.split('.')[-1].replace('-', '_').split('_')) + 'Record'
+        namespace = {'intern_str': intern_str}
+        exec(compile(class_source(class_name, nsid, fields, interned), f'<record {nsid}>', 'exec'), namespace)
+        classes[(nsid, fields)] = cls = namespace[class_name]
+        return cls
+
+def get_page(api, params):
+    # listing is read only, so 429s, 5xx and dropped connections are all
+    # retried, with the same backoff (and ratelimit-reset) as applyWrites
+    for attempt in range(MAX_RETRIES + 1):
+        response = None
+        try:
+            response = requests.get(api, params=params)
+            if response.status_code not in RETRY_STATUSES:
+                break
+            print(f"listRecords returned {response.status_code}, retrying ({attempt+1}/{MAX_RETRIES})")
+        except requests.exceptions.ConnectionError as e:
+            print(f"listRecords connection error: {e}, retrying ({attempt+1}/{MAX_RETRIES})")
+        if attempt < MAX_RETRIES:
+            stats.retry(api)
+            time.sleep(retry_delay(response, attempt))
+    else:
+        if response is None:
+            raise requests.exceptions.ConnectionError(f"listRecords failed after {MAX_RETRIES} retries")
+
+    if not response.ok:
+        print(f"Request failed. Status code: {response.status_code}. Response: {response.text}")
+    response.raise_for_status()
+    return response.json()
+
+def iter_pages(did, service, collection, limit=PAGE_SIZE):
+    # raw listRecords pages, one at a time
+    api = f"{service}/xrpc/com.atproto.repo.listRecords"
+    params = {'repo': did, 'collection': collection, 'limit': limit}
+    while True:
+        data = get_page(api, params)
+        records = data.get('records') or []
+        yield records
+        if not records or not (cursor := data.get('cursor')):
+            return
+        params['cursor'] = cursor
+
+def iter_records(did, service, cls, limit=PAGE_SIZE):
+    # converts each page as it arrives so the raw json for more than one
+    # page is never held
+    for records in iter_pages(did, service, cls.nsid, limit):
+        yield from map(cls.from_record, records)
+
+def list_records_as(did, service, cls):
+    return list(iter_records(did, service, cls))
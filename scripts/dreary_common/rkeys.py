@@ -0,0 +1,110 @@
+import bisect
+import heapq
+from array import array
+
+from .records import iter_records, record_class
+
+# existence index for one collection that keeps rkeys instead of full
+# at-uris, composing the uri only when a record is referenced. numeric
+# rkeys (discord snowflakes) live as 64-bit ints in a sorted array, with
+# recent additions in a set that is merged in once it grows; anything
+# else (hashes, emoji codepoints) stays in a plain set of strings.
+# writers (add, update, discard) share one lock. lookups don't need it:
+# the array is never changed in place, only replaced, so a lookup binds
+# it once and always bisects a consistent copy.
+
+MAX_RKEY = 2 ** 64 - 1
+# additions merged into the sorted array once the set reaches this, or
+# an eighth of the array, whichever is larger
+MERGE_THRESHOLD = 4096
+
+
+def as_int(rkey):
+    # only canonical decimals, so the rkey string can be rebuilt exactly
+    if type(rkey) is str and rkey.isdigit() and rkey.isascii() and (rkey == '0' or rkey[0] != '0'):
+        if (value := int(rkey)) <= MAX_RKEY:
+            return value
+    return None
+
+class RkeyIndex:
+    def __init__(self, did, collection, rkeys=()):
+        self.prefix = f'at://{did}/{collection}/'
+        numbers = []
+        self.strings = set()
+        for rkey in rkeys:
+            if (value := as_int(rkey)) is None:
+                self.strings.add(rkey)
+            else:
+                numbers.append(value)
+        self.numbers = array('Q', sorted(set(numbers)))
+        self.added = set()
+
+    @classmethod
+    def load(cls, did, service, collection):
+        # listing only ever holds one page of records at a time
+        listed = iter_records(did, service, record_class(collection, []))
+        return cls(did, collection, (record.uri.rsplit('/', 1)[-1] for record in listed))
+
+    def in_numbers(self, value, numbers=None):
+        if numbers is None:
+            numbers = self.numbers
+        i = bisect.bisect_left(numbers, value)
+        return i < len(numbers) and numbers[i] == value
+
+    def __contains__(self, rkey):
+        if (value := as_int(rkey)) is None:
+            return rkey in self.strings
+        # the set before the array: merge swaps the array in before it
+        # clears the set, so every rkey is in one of what's read here
+        added = self.added
+        numbers = self.numbers
+        return value in added or self.in_numbers(value, numbers)
+
+    def __getitem__(self, rkey):
+        if rkey not in self:
+            raise KeyError(rkey)
+        return self.prefix + rkey
+
+    def __len__(self):
+        return len(self.numbers) + len(self.added) + len(self.strings)
+
+    def __iter__(self):
+        yield from map(str, self.numbers)
+        yield from map(str, self.added)
+        yield from self.strings
+
+    def uri(self, rkey):
+        return self.prefix + rkey
+
+    def missing(self, rkeys):
+        return sorted(rkey for rkey in set(rkeys) if rkey not in self)
+
+    def add(self, rkey):
+        if (value := as_int(rkey)) is None:
+            self.strings.add(rkey)
+        elif not self.in_numbers(value):
+            self.added.add(value)
+            if len(self.added) >= max(MERGE_THRESHOLD, len(self.numbers) // 8):
+                self.merge()
+
+    def update(self, rkeys):
+        for rkey in rkeys:
+            self.add(rkey)
+
+    def merge(self):
+        # additions never overlap the array, so a merge of the two sorted
+        # runs is enough. the array is swapped in before the set is cleared,
+        # see __contains__ for the order readers take them in
+        self.numbers = array('Q', heapq.merge(self.numbers, sorted(self.added)))
+        self.added = set()
+
+    def discard(self, rkey):
+        if (value := as_int(rkey)) is None:
+            self.strings.discard(rkey)
+        elif value in self.added:
+            self.added.discard(value)
+        elif self.in_numbers(value, numbers := self.numbers):
+            # rare (failed imports only), so copying the array is fine and
+            # keeps it unchanged for anyone bisecting it right now
+            i = bisect.bisect_left(numbers, value)
+            self.numbers = numbers[:i] + numbers[i + 1:]
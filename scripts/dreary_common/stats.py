@@ -0,0 +1,203 @@
+import atexit
+import bisect
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+import requests
+
+# run instrumentation: time spent per phase, and per endpoint request
+# counts, latency histograms, bytes and retries, collected by wrapping
+# requests.Session.send (module-level requests.get/post go through it too).
+# DREARY_STATS picks where the json summary goes at the end of a run:
+# unset prints it to stderr, a path writes it there, 0 turns it all off.
+# DREARY_PROGRESS=1 adds a live progress line with an eta on stderr.
+STATS = os.getenv('DREARY_STATS', '')
+ENABLED = STATS != '0'
+PROGRESS = os.getenv('DREARY_PROGRESS') == '1'
+# latency histogram bucket upper bounds, in ms
+BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+lock = threading.Lock()
+original_send = None
+script = None
+started = None
+phases = {}
+endpoints = {}
+counters = {}
+progress_state = {}
+
+
+def reset():
+    global started
+    with lock:
+        started = time.time()
+        phases.clear()
+        endpoints.clear()
+        counters.clear()
+        progress_state.clear()
+
+def start(name):
+    # call once from a script's main. safe to call again
+    global script, original_send
+    script = name
+    if not ENABLED or original_send:
+        return
+    reset()
+    original_send = requests.Session.send
+    requests.Session.send = instrumented_send
+    atexit.register(report)
+
+@contextlib.contextmanager
+def phase(name):
+    # also works as a decorator. concurrent work in the same phase adds up,
+    # so `seconds` can exceed `wall` when a phase runs in several threads
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        with lock:
+            entry = phases.setdefault(name, {'count': 0, 'seconds': 0.0, 'first': begin, 'last': end})
+            entry['count'] += 1
+            entry['seconds'] += end - begin
+            entry['first'] = min(entry['first'], begin)
+            entry['last'] = max(entry['last'], end)
+
+def incr(name, amount=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + amount
+
+def endpoint_name(url):
+    parsed = urlparse(url)
+    if parsed.path.startswith('/xrpc/'):
+        return parsed.path[len('/xrpc/'):]
+    return parsed.netloc
+
+def endpoint_entry(name):
+    if name not in endpoints:
+        endpoints[name] = {
+            'count': 0,
+            'errors': 0,
+            'retries': 0,
+            'statuses': {},
+            'bytes_sent': 0,
+            'bytes_received': 0,
+            'seconds': 0.0,
+            'max_ms': 0.0,
+            'histogram': [0] * (len(BUCKETS) + 1),
+        }
+    return endpoints[name]
+
+def retry(url_or_endpoint):
+    # called by the retry loops, which know a request is being repeated
+    name = endpoint_name(url_or_endpoint) if '://' in url_or_endpoint else url_or_endpoint
+    with lock:
+        endpoint_entry(name)['retries'] += 1
+
+def body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    try:
+        return len(body)
+    except TypeError:
+        # generators and the like, size unknown up front
+        return 0
+
+def instrumented_send(self, request, **kwargs):
+    begin = time.perf_counter()
+    response = None
+    try:
+        response = original_send(self, request, **kwargs)
+        return response
+    finally:
+        elapsed = time.perf_counter() - begin
+        received = 0
+        if response is not None:
+            if kwargs.get('stream'):
+                received = int(response.headers.get('content-length') or 0)
+            else:
+                received = len(response.content or b'')
+        with lock:
+            entry = endpoint_entry(endpoint_name(request.url))
+            entry['count'] += 1
+            entry['bytes_sent'] += body_size(request.body)
+            entry['bytes_received'] += received
+            entry['seconds'] += elapsed
+            entry['max_ms'] = max(entry['max_ms'], elapsed * 1000)
+            entry['histogram'][bisect.bisect_left(BUCKETS, elapsed * 1000)] += 1
+            if response is None:
+                entry['errors'] += 1
+            else:
+                status = str(response.status_code)
+                entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+                if not response.ok:
+                    entry['errors'] += 1
+
+def progress(label, done, total=None):
+    # rate and eta are measured from the first call for a label
+    if not PROGRESS:
+        return
+    now = time.time()
+    with lock:
+        first = progress_state.setdefault(label, now)
+    elapsed = now - first
+    rate = done / elapsed if elapsed > 0 else 0
+    line = f'{label}: {done}' + (f'/{total}' if total else '') + f' ({rate:.1f}/s'
+    if total and rate:
+        line += f', eta {format_seconds((total - done) / rate)}'
+    print(f'\r\033[K{line})', end='' if not total or done < total else '\n', file=sys.stderr, flush=True)
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}' if hours else f'{minutes}:{seconds:02}'
+
+def summary():
+    with lock:
+        histogram_labels = [f'<={bound}ms' for bound in BUCKETS] + [f'>{BUCKETS[-1]}ms']
+        requests_summary = {
+            name: {
+                **{k: v for k, v in entry.items() if k not in ('seconds', 'histogram')},
+                'avg_ms': round(entry['seconds'] * 1000 / entry['count'], 1) if entry['count'] else 0,
+                'max_ms': round(entry['max_ms'], 1),
+                'histogram': {label: n for label, n in zip(histogram_labels, entry['histogram']) if n},
+            }
+            for name, entry in sorted(endpoints.items(), key=lambda e: -e[1]['seconds'])
+        }
+        return {
+            'script': script,
+            'started': datetime.fromtimestamp(started or time.time(), timezone.utc).isoformat(),
+            'seconds': round(time.time() - (started or time.time()), 3),
+            'phases': {
+                name: {'count': entry['count'], 'seconds': round(entry['seconds'], 3), 'wall': round(entry['last'] - entry['first'], 3)}
+                for name, entry in phases.items()
+            },
+            'requests': requests_summary,
+            'totals': {
+                'requests': sum(e['count'] for e in endpoints.values()),
+                'errors': sum(e['errors'] for e in endpoints.values()),
+                'retries': sum(e['retries'] for e in endpoints.values()),
+                'bytes_sent': sum(e['bytes_sent'] for e in endpoints.values()),
+                'bytes_received': sum(e['bytes_received'] for e in endpoints.values()),
+            },
+            'counters': dict(counters),
+        }
+
+def report():
+    if not ENABLED or started is None:
+        return
+    data = summary()
+    if STATS and STATS != '1':
+        with open(STATS, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        print(f"Run stats written to {STATS}", file=sys.stderr)
+    else:
+        print(json.dumps(data, indent=2), file=sys.stderr)
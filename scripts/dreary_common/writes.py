@@ -0,0 +1,213 @@
+import queue
+import threading
+import time
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from . import stats
+from .identity import refresh_session
+from .lexicons import screen_writes
+
+# com.atproto.repo.applyWrites rejects more than 200 writes per call
+MAX_WRITES = 200
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMITED = 429
+
+
+def split_list(lst, chunk_size):
+    return [lst[i:i + chunk_size] for i in range(0, len(lst), chunk_size)]
+
+def retry_delay(response, attempt):
+    # the PDS sends the reset time as a unix timestamp on 429s
+    if response is not None and (reset := response.headers.get('ratelimit-reset')):
+        try:
+            return max(float(reset) - time.time(), 1)
+        except ValueError:
+            pass
+    return min(2 ** attempt, 60)
+
+def retry_safe(writes):
+    # a 5xx or a dropped connection may still have committed the batch. a
+    # repeated create with an explicit rkey is rejected as already existing
+    # (see already_committed), but a create without one gets a fresh tid
+    # every time, so those batches only retry what never reached the PDS
+    return all(write.get('rkey') or write.get('$type') != "com.atproto.repo.applyWrites#create" for write in writes)
+
+def never_sent(error):
+    # refused or unresolvable connections and connect timeouts fail before
+    # the request goes out
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+def already_committed(response):
+    # applyWrites is atomic, so a retry rejected because one of its creates
+    # exists means the attempt that failed on our end went through
+    try:
+        return response.status_code == 400 and 'already exists' in (response.json().get('message') or '').lower()
+    except ValueError:
+        return False
+
+def token_expired(response):
+    try:
+        return response.status_code in (400, 401) and response.json().get('error') == 'ExpiredToken'
+    except ValueError:
+        return False
+
+@stats.phase('writes')
+def apply_writes(session, service, writes):
+    api = f"{service}/xrpc/com.atproto.repo.applyWrites"
+    payload = {
+        "repo": session.get('did'),
+        "writes": writes
+    }
+    refreshed = False
+    safe = retry_safe(writes)
+    retry_statuses = RETRY_STATUSES if safe else {RATE_LIMITED}
+    # set once an attempt may have committed without us seeing the result
+    uncertain = False
+    for attempt in range(MAX_RETRIES + 1):
+        response = None
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Authorization': f"Bearer {session.get('accessJwt')}"
+        }
+        try:
+            response = requests.post(api, headers=headers, json=payload)
+            if token_expired(response) and not refreshed:
+                # long imports outlive the access token
+                refresh_session(session, service)
+                refreshed = True
+                continue
+            if response.status_code not in retry_statuses:
+                break
+            uncertain = uncertain or response.status_code != RATE_LIMITED
+            print(f"applyWrites returned {response.status_code}, retrying ({attempt+1}/{MAX_RETRIES})")
+        except requests.exceptions.ConnectionError as e:
+            if not (safe or never_sent(e)):
+                raise
+            uncertain = uncertain or not never_sent(e)
+            print(f"applyWrites connection error: {e}, retrying ({attempt+1}/{MAX_RETRIES})")
+        if attempt < MAX_RETRIES:
+            stats.retry(api)
+            time.sleep(retry_delay(response, attempt))
+    else:
+        if response is None:
+            raise requests.exceptions.ConnectionError(f"applyWrites failed after {MAX_RETRIES} retries")
+
+    if uncertain and already_committed(response):
+        print("applyWrites batch was already committed by an earlier attempt")
+        return {'results': [
+            {'uri': f"at://{payload['repo']}/{write['collection']}/{write['rkey']}"}
+            for write in writes if write.get('rkey')
+        ]}
+    if not response.ok:
+        print(f"Request failed. Status code: {response.status_code}. Response: {response.text}")
+    response.raise_for_status()
+    return response.json()
+
+def to_write(record):
+    if record['$type'].split('#')[0] == 'com.atproto.repo.applyWrites':
+        # if the record is an applyWrites record, use it directly
+        # this allows for non-creation writes
+        return record
+    return {
+        "$type": "com.atproto.repo.applyWrites#create",
+        "collection": record['$type'],
+        "value": record,
+    }
+
+def create_write(record, rkey):
+    return {
+        "$type": "com.atproto.repo.applyWrites#create",
+        "collection": record['$type'],
+        "rkey": rkey,
+        "value": record,
+    }
+
+def apply_writes_batch(session, service, records, chunk_size=MAX_WRITES):
+    if len(records) == 0:
+        return []
+
+    writes = [to_write(record) for record in records]
+    # invalid records are quarantined up front rather than failing the
+    # whole batch they'd land in
+    valid = screen_writes(writes)
+    batchable = [write for write, ok in zip(writes, valid) if ok]
+
+    uris = []
+    split_batches = split_list(batchable, chunk_size)
+    total_batches = len(split_batches)
+    for i, batch in enumerate(split_batches):
+        response = apply_writes(session, service, batch)
+        uris.extend(uri for result in (response.get('results') or []) if (uri := result.get('uri')))
+        print(f"{i+1}/{total_batches} applyWrites complete")
+        stats.progress('writes', min((i + 1) * chunk_size, len(batchable)), len(batchable))
+    if len(batchable) == len(writes):
+        return uris
+    # still one entry per create/update, None where it was quarantined
+    results = iter(uris)
+    return [next(results, None) if ok else None for write, ok in zip(writes, valid) if 'value' in write]
+
+class WriteScheduler:
+    # a single writer thread drains a queue into full applyWrites batches,
+    # so concurrent producers share one PDS rate limit instead of racing
+    # each other into 429s. partial batches go out once the queue idles
+    STOP = object()
+
+    def __init__(self, session, service, chunk_size=MAX_WRITES, flush_interval=2):
+        self.session = session
+        self.service = service
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        # bounded so producers can't run arbitrarily far ahead of the PDS
+        self.queue = queue.Queue(maxsize=chunk_size * 10)
+        self.error = None
+        self.written = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, records):
+        for record in records:
+            if self.error:
+                raise self.error
+            write = to_write(record)
+            if screen_writes([write])[0]:
+                self.queue.put(write)
+
+    def flush(self, batch):
+        if not batch or self.error:
+            return
+        try:
+            apply_writes(self.session, self.service, batch)
+            self.written += len(batch)
+            print(f"{self.written} writes applied")
+            stats.progress('writes', self.written)
+        except Exception as e:
+            # keep draining so blocked producers wake up and see the error
+            self.error = e
+
+    def run(self):
+        batch = []
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self.flush(batch)
+                batch = []
+                continue
+            if item is self.STOP:
+                self.flush(batch)
+                return
+            batch.append(item)
+            if len(batch) >= self.chunk_size:
+                self.flush(batch)
+                batch = []
+
+    def close(self):
+        self.queue.put(self.STOP)
+        self.thread.join()
+        if self.error:
+            raise self.error
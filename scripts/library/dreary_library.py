@@ -1,9 +1,17 @@
 from bsky_utils import *
-import fitz
+import argparse
 import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from dreary_common import stats
+from dreary_common.config import login
+from dreary_common.images import prepare_image
+from dreary_common.writes import apply_writes_batch
 
 
 def print_pdf_metadata(path):
+    import fitz
     doc = fitz.open(path)
     metadata = doc.metadata
     for key, value in metadata.items():
@@ -25,7 +33,8 @@ def create_book_record(session, service, path):
     #     record = add_description(record, path)
 
     record['$type'] = 'dev.dreary.library.book'
-    record['file'] = upload_blob(session, service, path)
+    with stats.phase('blob upload'):
+        record['file'] = upload_blob(session, service, path)
     record['createdAt'] = generate_timestamp()
 
     return record
@@ -41,6 +50,8 @@ def create_book_metadata(path):
             "authors": []
         }
     
+    # pymupdf is heavy, only pdfs need it
+    import fitz
     doc = fitz.open(path)
     metadata = doc.metadata
     authors = metadata.get('author')
@@ -163,24 +174,48 @@ def select_book_uri(books):
 
     return book_uris
 
+def build_shelf_index(shelf_items):
+    shelf_index = {}
+    for item in shelf_items:
+        shelf_uri = traverse(item, ['value', 'shelf'])
+        book_uri = traverse(item, ['value', 'book'])
+        if shelf_uri and book_uri:
+            shelf_index.setdefault(shelf_uri, set()).add(book_uri)
+    return shelf_index
+
 def add_books_to_shelf(session, service):
-    shelves = list_records(session.get('did'), service, 'dev.dreary.library.shelf')
+    with stats.phase('index load'):
+        shelves = list_records(session.get('did'), service, 'dev.dreary.library.shelf')
     shelf_uri = select_shelf_uri(session, service, shelves)
     if not shelf_uri: return
 
-    books = list_records(session.get('did'), service, 'dev.dreary.library.book')
+    with stats.phase('index load'):
+        books = list_records(session.get('did'), service, 'dev.dreary.library.book')
     book_uris = select_book_uri(books)
     if not book_uris: return
 
-    apply_writes_create(session, service, [
-        {
+    with stats.phase('index load'):
+        shelf_items = list_records(session.get('did'), service, 'dev.dreary.library.shelfitem')
+    shelved = build_shelf_index(shelf_items).get(shelf_uri, set())
+
+    records = []
+    for book_uri in dict.fromkeys(book_uris):
+        if book_uri in shelved:
+            continue
+        records.append({
             "$type": 'dev.dreary.library.shelfitem',
             "book": book_uri,
             "shelf": shelf_uri,
             "createdAt": generate_timestamp()
-        }
-        for book_uri in book_uris
-    ])
+        })
+
+    if skipped := len(set(book_uris)) - len(records):
+        print(f"{skipped} book(s) already on shelf.")
+    if not records:
+        print("No shelfitem record creation required.")
+        return
+
+    apply_writes_batch(session, service, records)
     print("Book(s) added to shelf successfully.")
 
 def create_shelf(session, service):
@@ -192,25 +227,21 @@ def create_shelf(session, service):
         "description": input("Description: ")
     }
     if icon_path := input("Icon file path: "):
-        record['icon'] = upload_blob(session, service, icon_path)
+        record['icon'] = upload_blob(session, service, prepare_image(icon_path))
     print()
     return create_record(session, service, record)
 
-def main():
-    with open('../../config.json') as f:
-        config = json.load(f)
-    HANDLE = config.get('HANDLE')
-    PASSWORD = config.get('PASSWORD')
-    if not (HANDLE and PASSWORD):
-        print('Enter credentials in config.json')
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Create dev.dreary.library books and shelves. Interactive without a file.")
+    parser.add_argument('book', nargs='?', help="book file to upload straight away")
+    args = parser.parse_args(argv)
+    stats.start('dreary_library')
+    did, service, session = login()
+    if not session:
         return
-    
-    did = resolve_handle(HANDLE)
-    service = get_service_endpoint(did)
-    session = get_session(did, PASSWORD, service)
 
-    if len(sys.argv) >= 2:
-        return create_one_book(session, service, sys.argv[1])
+    if args.book:
+        return create_one_book(session, service, args.book)
 
     while True:
         print()
@@ -0,0 +1,109 @@
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent))
+from dreary_common import stats
+from dreary_common.config import login
+from dreary_common.records import iter_pages
+from dreary_common.writes import WriteScheduler
+
+# deletes records from dev.dreary.* collections, e.g. to clean up a bad
+# import. the collection is listed page by page on this thread while the
+# write scheduler's thread sends applyWrites#delete batches, so listing the
+# next page overlaps deleting the last one. both sides wait out 429s with
+# the same backoff. listRecords pages on rkey, so deleting records
+# that were already listed never shifts the cursor.
+#   python purge.py dev.dreary.discord.message --ref at://did:plc:.../dev.dreary.discord.channel/123 --dry-run
+#   python purge.py dev.dreary.tunes.playlistitem --where playlist=at://did:plc:.../dev.dreary.tunes.playlist/3k...
+
+PREFIX = 'dev.dreary.'
+
+
+def parse_where(value):
+    field, sep, expected = value.partition('=')
+    if not (sep and field):
+        raise argparse.ArgumentTypeError(f"expected FIELD=VALUE, got {value!r}")
+    return field.split('.'), expected
+
+def field_value(value, path):
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+def matcher(wheres, refs):
+    # every --where has to match, and any field may hold a --ref uri
+    def matches(record):
+        value = record.get('value') or {}
+        for path, expected in wheres:
+            actual = field_value(value, path)
+            if actual is None or (actual if isinstance(actual, str) else str(actual)) != expected:
+                return False
+        if refs and not any(v in refs for v in value.values() if isinstance(v, str)):
+            return False
+        return True
+    return matches
+
+def delete_write(record):
+    collection, rkey = record['uri'].split('/')[-2:]
+    return {
+        "$type": "com.atproto.repo.applyWrites#delete",
+        "collection": collection,
+        "rkey": rkey,
+    }
+
+def purge_collection(did, service, collection, matches, writer=None):
+    # writer=None is a dry run: everything is listed and counted, nothing
+    # is deleted. with a writer, `matched` is only what was queued, and
+    # writer.written says what actually went
+    listed = matched = 0
+    for records in iter_pages(did, service, collection):
+        listed += len(records)
+        doomed = [record for record in records if matches(record)]
+        matched += len(doomed)
+        if writer and doomed:
+            writer.submit(delete_write(record) for record in doomed)
+        stats.progress(f'{collection} listed', listed)
+    return listed, matched
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Delete records from dev.dreary.* collections, optionally filtered.")
+    parser.add_argument('collections', nargs='+', metavar='COLLECTION', help="collection NSID, e.g. dev.dreary.discord.message")
+    parser.add_argument('--where', action='append', default=[], type=parse_where, metavar='FIELD=VALUE', help="only records whose (dotted) field equals VALUE, repeatable")
+    parser.add_argument('--ref', action='append', default=[], metavar='URI', help="only records with a top-level field set to URI (a playlist, project, channel...), repeatable")
+    parser.add_argument('--dry-run', action='store_true', help="list and count matches without deleting anything")
+    parser.add_argument('--yes', action='store_true', help="don't ask before deleting")
+    args = parser.parse_args(argv)
+
+    if (bad := [c for c in args.collections if not c.startswith(PREFIX)]):
+        parser.error(f"only {PREFIX}* collections can be purged: {', '.join(bad)}")
+    stats.start('purge')
+    did, service, session = login()
+    if not session:
+        return
+
+    if not (args.dry_run or args.yes):
+        scope = 'matching records' if (args.where or args.ref) else 'EVERY record'
+        answer = input(f"Delete {scope} in {', '.join(args.collections)} from {did}? [y/N] ")
+        if answer.strip().lower() not in ('y', 'yes'):
+            return
+
+    matches = matcher(args.where, set(args.ref))
+    for collection in args.collections:
+        if args.dry_run:
+            listed, matched = purge_collection(did, service, collection, matches)
+            print(f"{collection}: would delete {matched} of {listed} record(s)")
+            continue
+        # a scheduler per collection, so its written count is this
+        # collection's and is final once close() returns
+        writer = WriteScheduler(session, service)
+        try:
+            listed, matched = purge_collection(did, service, collection, matches, writer)
+        finally:
+            writer.close()
+        print(f"{collection}: deleted {writer.written} of {matched} matching record(s), {listed} listed")
+
+if __name__ == "__main__":
+    main()
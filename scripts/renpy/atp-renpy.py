@@ -1,12 +1,18 @@
+import argparse
 import json
 import os
 import subprocess
 import sys
 import textwrap
 from datetime import datetime, timezone
+from pathlib import Path
 
 import requests
-from dotenv import load_dotenv
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from dreary_common import stats
+from dreary_common.identity import get_service_endpoint, get_session, resolve_handle
+from dreary_common.images import prepare_image
 
 
 def linkify(text, link=None, file=False):
@@ -29,37 +35,6 @@ def safe_request(req_type, url, headers=None, params=None, data=None, json=None)
         raise
     return response.json()
 
-def resolve_handle(handle):
-    if handle.startswith("did:"):
-        return handle
-    if handle.startswith("@"):
-        handle = handle[1:]
-    if not handle:
-        return None
-    url = f'https://public.api.bsky.app/xrpc/com.atproto.identity.resolveHandle?handle={handle}'
-    return (safe_request('get', url) or {}).get('did')
-
-def get_session(username, password, service_endpoint):
-    url = f'{service_endpoint}/xrpc/com.atproto.server.createSession'
-    payload = {
-        'identifier': username,
-        'password': password,
-    }
-    return safe_request('post', url, json=payload)
-
-def get_did_doc(did):
-    if did.startswith('did:web:'):
-        url = f'https://{did[8:]}/.well-known/did.json'
-    else:
-        url = f'https://plc.directory/{did}'
-    return safe_request('get', url)
-
-def get_service_endpoint(did):
-    for service in (get_did_doc(did).get('service') or []):
-        if service.get('type') == 'AtprotoPersonalDataServer':
-            return service.get('serviceEndpoint')
-    return None
-
 def create_record(session, service_endpoint, record):
     token = session.get('accessJwt')
     did = session.get('did')
@@ -189,7 +164,10 @@ def draft_asset_record(session, service, root, fullpath, project_uri):
             contents = f.read()
         record['contents'] = contents
     else:
-        blob = upload_blob(session, service, fullpath, mimetypes[ext])
+        # game code refers to assets by path and lays them out by size, so
+        # images only get a lossless same-format recompress
+        upload_path = prepare_image(fullpath, keep_format=True) if ext == '.png' else fullpath
+        blob = upload_blob(session, service, upload_path, mimetypes[ext])
         if not blob:
             print(f"Blob upload failed for {fullpath}. Canceling record creation.")
             return
@@ -197,6 +175,7 @@ def draft_asset_record(session, service, root, fullpath, project_uri):
     
     return record
 
+@stats.phase('blob upload')
 def draft_asset_records(session, service, root, project_uri):
     records = []
     for dirpath, _, filenames in os.walk(root):
@@ -210,6 +189,7 @@ def draft_asset_records(session, service, root, project_uri):
 def split_list(lst, chunk_size):
     return [lst[i:i + chunk_size] for i in range(0, len(lst), chunk_size)]
 
+@stats.phase('writes')
 def apply_writes_batch(session, service, records):
     if len(records) == 0:
         print("No records to write.")
@@ -219,6 +199,7 @@ def apply_writes_batch(session, service, records):
     for i, batch in enumerate(split_batches):
         apply_writes_create(session, service, batch)
         print(f"{i+1}/{total_batches} applyWrites complete")
+        stats.progress('writes', min((i + 1) * 200, len(records)), len(records))
 
 def download_blob(service, did, cid, path):
     api = f'{service}/xrpc/com.atproto.sync.getBlob'
@@ -275,19 +256,19 @@ def download_asset(service, did, dl_dir, record):
     else:
         print(f"{uri} has no data to download.")
 
-def upload_renpy():
+def upload_renpy(root=None, project_name=None):
     # python atp-renpy.py upload [DIR] [NAME]
-    root = sys.argv[2] if (len(sys.argv) >= 3) else input("Enter a Ren'Py game directory: ")
+    root = root or input("Enter a Ren'Py game directory: ")
     if not os.path.isdir(root):
         print("Enter a valid directory.")
         return
 
-    project_name = sys.argv[3] if (len(sys.argv) >= 4) else None
     project_name = name_prompt(project_name)
     if not project_name:
         print("No name provided. Quitting.")
         return
 
+    from dotenv import load_dotenv
     load_dotenv()
     handle = os.getenv("HANDLE")
     password = os.getenv("PASSWORD")
@@ -325,14 +306,14 @@ def upload_renpy():
     apply_writes_batch(session, service, records)
     print(f"Writes applied. https://pdsls.dev/at://{did}/dev.dreary.renpy.asset")
 
-def download_renpy():
+def download_renpy(dl_dir=None, project_uri=None):
     # python atp-renpy.py download [DOWNLOAD DIR] [PROJECT AT-URI]
-    dl_dir = sys.argv[2] if (len(sys.argv) >= 3) else input("Enter a download directory: ")
+    dl_dir = dl_dir or input("Enter a download directory: ")
     if not os.path.isdir(dl_dir):
         print("Enter a valid directory.")
         return
 
-    project_uri = sys.argv[3] if (len(sys.argv) >= 4) else input("Enter a project AT-URI: ")
+    project_uri = project_uri or input("Enter a project AT-URI: ")
     if not project_uri.startswith("at://"):
         print("AT-URI not provided.")
         return
@@ -356,26 +337,35 @@ def download_renpy():
 
     print(f'Downloads complete. {linkify(dl_dir, file=True)}')
 
-def main():
-    mode = sys.argv[1] if (len(sys.argv) >= 2) else "--help"
-    if mode == "--help":
-        print(textwrap.dedent(f"""
-            To upload:
-            python atp-renpy.py upload [GAME FILES DIRECTORY] [PROJECT NAME]
-
-            To download:
-            python atp-renpy.py download [DOWNLOAD DIRECTORY] [PROJECT AT-URI]
-
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description="Upload a Ren'Py game as dev.dreary.renpy records, or download one back.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=textwrap.dedent(f"""
             Specify 'HANDLE' and 'PASSWORD' in a .env file in the same
             directory as this script to avoid being prompted on upload
 
             Download the Ren'Py SDK to run downloaded games:
             {linkify('https://www.renpy.org/latest.html')}
-        """))
-    elif mode.upper().startswith("U"):
-        upload_renpy()
-    elif mode.upper().startswith("D"):
-        download_renpy()
+        """),
+    )
+    modes = parser.add_subparsers(dest='mode', metavar='{upload,download}')
+    upload = modes.add_parser('upload', aliases=['u', 'up'], help="upload a game directory as a new project")
+    upload.add_argument('root', nargs='?', metavar='GAME_FILES_DIRECTORY')
+    upload.add_argument('project_name', nargs='?', metavar='PROJECT_NAME')
+    download = modes.add_parser('download', aliases=['d', 'dl'], help="download a project's assets")
+    download.add_argument('dl_dir', nargs='?', metavar='DOWNLOAD_DIRECTORY')
+    download.add_argument('project_uri', nargs='?', metavar='PROJECT_AT_URI')
+    args = parser.parse_args(argv)
+    if not args.mode:
+        return parser.print_help()
+
+    stats.start('atp-renpy')
+    if args.mode in ('upload', 'u', 'up'):
+        upload_renpy(args.root, args.project_name)
+    else:
+        download_renpy(args.dl_dir, args.project_uri)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,16 +1,40 @@
-from soundcloud import SoundCloud, MiniTrack
 import json
 from pathlib import Path
 import datetime
 import subprocess
 import sys
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlparse
 from bsky_utils import *
 import requests
-import bs4
-import demjson3
-from yt_dlp import YoutubeDL
+import re
+import html
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from dreary_common import stats
+from dreary_common.http_cache import cached_get
+from dreary_common.config import load_config, login
+from dreary_common.records import iter_records, record_class
+from dreary_common.writes import apply_writes_batch
+from playlist_order import PlaylistItem, PlaylistOrder
+from fractional_order import FractionalOrder, iter_playlist_items
 
 class BandcampJSON:
+    # the data lives in html-escaped json attributes and one ld+json script,
+    # so scan for those directly instead of building a DOM of the whole page
+    PAGEDATA_TAG = re.compile(r'<div\b[^>]*\bid="pagedata"[^>]*>')
+    DATA_BLOB = re.compile(r'\bdata-blob="([^"]*)"')
+    TRALBUM = re.compile(r'\bdata-tralbum="([^"]*)"')
+    LD_JSON = re.compile(r'<script\b[^>]*\btype="application/ld\+json"[^>]*>(.*?)</script>', re.S)
+
     def __init__(self, body, debugging: bool = False):
         self.body = body
         self.json_data = []
@@ -21,51 +45,55 @@ class BandcampJSON:
         return self.json_data
 
     def get_pagedata(self):
-        pagedata = self.body.find('div', {'id': 'pagedata'})['data-blob']
-        self.json_data.append(pagedata)
+        if (tag := self.PAGEDATA_TAG.search(self.body)) and (blob := self.DATA_BLOB.search(tag.group(0))):
+            self.json_data.append(self.parse_json(html.unescape(blob.group(1))))
 
     def get_js(self):
-        embedded_scripts_raw = [self.body.find("script", {"type": "application/ld+json"}).string]
-        for script in self.body.find_all('script'):
-            try:
-                album_info = script['data-tralbum']
-                embedded_scripts_raw.append(album_info)
-            except Exception:
-                continue
-        for script in embedded_scripts_raw:
-            js_data = self.js_to_json(script)
-            self.json_data.append(js_data)
+        if (script := self.LD_JSON.search(self.body)):
+            self.json_data.append(self.parse_json(script.group(1)))
+        for album_info in self.TRALBUM.findall(self.body):
+            self.json_data.append(self.parse_json(html.unescape(album_info)))
+
+    @staticmethod
+    def parse_json(js_data):
+        # bandcamp serves strict json nowadays. demjson3 is only pulled in
+        # for the odd page that still has js literals in it
+        try:
+            return orjson.loads(js_data) if orjson else json.loads(js_data)
+        except ValueError:
+            import demjson3
+            return demjson3.decode(js_data)
 
-    def js_to_json(self, js_data):
-        decoded_js = demjson3.decode(js_data)
-        return demjson3.encode(decoded_js)
+# release pages rarely change once published
+BANDCAMP_CACHE_TTL = 7 * 24 * 60 * 60
 
-def bc_playlist(playlist_url):
-    session = requests.Session()
-    response = session.get(playlist_url)
+def bc_playlist(playlist_url, extraction=None, session=None):
+    session = session or requests.Session()
+    response = cached_get(playlist_url, ttl=BANDCAMP_CACHE_TTL, session=session)
 
     if not response.ok:
         print(f"Status code: {response.status_code}", )
         print(f"The Album/Track requested does not exist at: {playlist_url}")
         return None, None
 
-    try:
-        soup = bs4.BeautifulSoup(response.text, "lxml")
-    except bs4.FeatureNotFound:
-        soup = bs4.BeautifulSoup(response.text, "html.parser")
-
-    bandcamp_json = BandcampJson(soup, False).generate()
     page_json = {}
-    for entry in bandcamp_json:
-        page_json = {**page_json, **json.loads(entry)}
-
-    if not (tracklist := traverse(page_json, ['track', 'itemListElement'])):
+    for entry in BandcampJSON(response.text).generate():
+        if isinstance(entry, dict):
+            page_json.update(entry)
+
+    tracklist = traverse(page_json, ['track', 'itemListElement'])
+    # standalone track pages describe the one track at the top level and
+    # come back without a playlist record
+    single = not tracklist and page_json.get('@type') == 'MusicRecording'
+    if single:
+        tracklist = [{'item': page_json}]
+    if not tracklist:
         print("No tracks found in the playlist.")
         return None, None
 
     thumbnail_url = page_json.get('image')
 
-    playlist_record = {
+    playlist_record = None if single else {
         "$type": "dev.dreary.tunes.playlist",
         "thumbnail": thumbnail_url,
         "name": page_json.get('name'),
@@ -85,8 +113,10 @@ def bc_playlist(playlist_url):
     }
     trackinfos = page_json['trackinfo']
 
-    tracks = []
+    tracks = extraction.start(playlist_record) if extraction else []
     for track in tracklist:
+        if extraction and extraction.cancelled:
+            break
         track = track['item']
         track_id = traverse(track, ['additionalProperty', {'name': 'track_id'}, 'value'])
         trackinfo = traverse(trackinfos, [{'id': track_id}], [{'track_id': track_id}])
@@ -105,7 +135,78 @@ def bc_playlist(playlist_url):
         tracks.append(record)
     return playlist_record, tracks
 
-def sc_playlist(playlist_url):
+# crawling a label can mean hundreds of release pages. keep it polite:
+# a shared connection pool, a few requests in flight, fewer per host
+CRAWL_WORKERS = 8
+CRAWL_HOST_LIMIT = 2
+
+class HostLimiter:
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def __call__(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            return self.semaphores.setdefault(host, threading.Semaphore(self.limit))
+
+def bc_release_urls(music_url, session):
+    # an artist/label /music page links every album and track. big grids
+    # only render the first batch and keep the rest in data-client-items
+    # the release list is what changes, so it gets a short ttl
+    response = cached_get(music_url, ttl=60 * 60, session=session)
+    response.raise_for_status()
+    page = response.text
+
+    paths = re.findall(r'href="((?:https://[^"/]+)?/(?:album|track)/[^"?#]+)', page)
+    for client_items in re.findall(r'\bdata-client-items="([^"]*)"', page):
+        for item in BandcampJSON.parse_json(html.unescape(client_items)) or []:
+            if (page_url := item.get('page_url')):
+                paths.append(page_url)
+
+    return list(dict.fromkeys(urljoin(music_url, path) for path in paths))
+
+def bc_crawl(music_url):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=CRAWL_WORKERS, pool_maxsize=CRAWL_WORKERS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    host_limit = HostLimiter(CRAWL_HOST_LIMIT)
+
+    if urlparse(music_url).path.strip('/') == '':
+        music_url = urljoin(music_url, '/music')
+    release_urls = bc_release_urls(music_url, session)
+    print(f"Found {len(release_urls)} release(s) at {music_url}")
+
+    def fetch(url):
+        with host_limit(url):
+            try:
+                return url, *bc_playlist(url, session=session)
+            except Exception as e:
+                print(f"Failed to extract {url}: {e}")
+                return url, None, None
+
+    # map keeps discography order while pages are fetched ahead
+    with ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as executor:
+        yield from executor.map(fetch, release_urls)
+
+def crawl_bandcamp(music_url, index, session, service, ordering=None):
+    mirrored = 0
+    for url, playlist_record, tracks in bc_crawl(music_url):
+        if not tracks:
+            continue
+        print(f"Mirroring {url}")
+        if playlist_record:
+            mirror_playlist(playlist_record, tracks, index, session, service, ordering)
+        else:
+            find_or_create_track_uris(tracks, index, session, service)
+        mirrored += 1
+    print(f"{mirrored} release(s) mirrored from {music_url}")
+
+def sc_playlist(playlist_url, extraction=None):
+    # provider libraries are slow to import, only load the one a url needs
+    from soundcloud import SoundCloud, MiniTrack
     client = SoundCloud(client_id=None)
     playlist = client.resolve(playlist_url)
 
@@ -126,13 +227,20 @@ def sc_playlist(playlist_url):
         }
     }
 
-    tracks = []
+    tracks = extraction.start(playlist_record) if extraction else []
     for track in playlist.tracks:
+        if extraction and extraction.cancelled:
+            break
         if isinstance(track, MiniTrack):
-            if playlist.secret_token:
-                track = client.get_tracks([track.id], playlist.id, playlist.secret_token)[0]
-            else:
-                track = client.get_track(track.id)
+            try:
+                if playlist.secret_token:
+                    track = client.get_tracks([track.id], playlist.id, playlist.secret_token)[0]
+                else:
+                    track = client.get_track(track.id)
+            except Exception as e:
+                # one deleted or geoblocked track shouldn't sink the playlist
+                print(f"Skipping SoundCloud track {track.id}: {e}")
+                continue
 
         record = {
             "$type": "dev.dreary.tunes.track",
@@ -154,13 +262,36 @@ def sc_playlist(playlist_url):
 
     return playlist_record, tracks
 
-def yt_playlist(playlist_url):
+def yt_track(track):
+    return {
+        "$type": "dev.dreary.tunes.track",
+        "title": track.get('title'),
+        "uploader": {
+            "name": track.get('uploader'),
+            "id": track.get('channel_id'),
+            "url": track.get('channel_url'),
+        },
+        "thumbnail": track.get('thumbnail'),
+        # yt-dlp reports fractional seconds, the lexicon wants an integer
+        "duration": round(duration) if (duration := track.get('duration')) is not None else None,
+        "description": track.get('description'),
+        "url": track.get('webpage_url'),
+        "id": track.get('id'),
+        "source": "YouTube",
+        "createdAt": generate_timestamp(),
+    }
+
+def yt_playlist(playlist_url, extraction=None):
     print("Retrieving YouTube playlist data (yt-dlp)...")
+    from yt_dlp import YoutubeDL
 
     ydl_opts = {
         'quiet': True,
-        'extract_flat': False,
-        'dump_single_json': True,
+        # list the entries cheaply first, then resolve them one at a time so
+        # a timeout still leaves everything resolved so far
+        'extract_flat': 'in_playlist',
+        # unavailable/private entries are skipped instead of failing the playlist
+        'ignoreerrors': True,
     }
 
     with YoutubeDL(ydl_opts) as ydl:
@@ -171,197 +302,373 @@ def yt_playlist(playlist_url):
             print(f"Failed to retrieve playlist: {e}")
             return None, None
 
-    if not playlist.get('entries'):
-        print("No tracks found in the playlist.")
-        return None, None
+        if not playlist or not (entries := [entry for entry in playlist.get('entries') or [] if entry]):
+            print("No tracks found in the playlist.")
+            return None, None
 
-    playlist_id = playlist.get('id')
+        playlist_id = playlist.get('id')
 
-    playlist_record = {
-        "$type": "dev.dreary.tunes.playlist",
-        "thumbnail": traverse(playlist, ['thumbnail'], ['thumbnails', -2, 'url']),
-        "name": playlist.get('title'),
-        "description": playlist.get('description'),
-        "createdAt": generate_timestamp(),
-        "reference": {
-            "source": "YouTube",
-            "link": f'https://www.youtube.com/playlist?list={playlist_id}' if playlist_id else None,
-            "id": playlist_id
+        playlist_record = {
+            "$type": "dev.dreary.tunes.playlist",
+            "thumbnail": traverse(playlist, ['thumbnail'], ['thumbnails', -2, 'url']),
+            "name": playlist.get('title'),
+            "description": playlist.get('description'),
+            "createdAt": generate_timestamp(),
+            "reference": {
+                "source": "YouTube",
+                "link": f'https://www.youtube.com/playlist?list={playlist_id}' if playlist_id else None,
+                "id": playlist_id
+            }
         }
-    }
 
-    tracks = []
-    for track in playlist.get('entries'):
-        if not track:
-            continue
-        tracks.append({
-            "$type": "dev.dreary.tunes.track",
-            "title": track.get('title'),
-            "uploader": {
-                "name": track.get('uploader'),
-                "id": track.get('channel_id'),
-                "url": track.get('channel_url'),
-            },
-            "thumbnail": track.get('thumbnail'),
-            "duration": track.get('duration'),
-            "description": track.get('description'),
-            "url": track.get('webpage_url'),
-            "id": track.get('id'),
-            "source": "YouTube",
-            "createdAt": generate_timestamp(),
-        })
+        tracks = extraction.start(playlist_record) if extraction else []
+        for entry in entries:
+            if extraction and extraction.cancelled:
+                break
+            url = entry.get('url') or f"https://www.youtube.com/watch?v={entry.get('id')}"
+            try:
+                track = ydl.extract_info(url, download=False)
+            except Exception as e:
+                print(f"Skipping YouTube entry {url}: {e}")
+                continue
+            if track:
+                tracks.append(yt_track(track))
 
     return playlist_record, tracks
 
-def process_playlist(url):
+# how many extractions of each provider may run at once. yt-dlp is heavy
+# and youtube is quick to throttle, the APIs are more forgiving
+PROVIDER_WORKERS = {
+    'youtube': 2,
+    'soundcloud': 4,
+    'bandcamp': 4,
+    'spotify': 4,
+}
+
+def get_provider(url):
+    hostname = url.split('/')[2] if url.count('/') >= 2 else ''
+    for provider, needle in [('soundcloud', 'soundcloud'), ('bandcamp', 'bandcamp'), ('youtube', 'youtu'), ('spotify', 'spotify')]:
+        if needle in hostname:
+            return provider
+    return None
+
+# seconds a single source may run before its results are abandoned
+PROVIDER_TIMEOUTS = {
+    'youtube': 900,
+    'soundcloud': 300,
+    'bandcamp': 120,
+    'spotify': 300,
+}
+
+class Extraction:
+    # extractors register their playlist record and append tracks as they
+    # go, so a source that times out still leaves an in-order prefix
+    def __init__(self, url, provider):
+        self.url = url
+        self.provider = provider
+        self.playlist_record = None
+        self.tracks = []
+        self.started = None
+        # set once the source has timed out. threads can't be killed, so
+        # the extractors check it between entries and stop early
+        self.cancelled = False
+
+    def start(self, playlist_record):
+        self.playlist_record = playlist_record
+        return self.tracks
+
+    def run(self):
+        self.started = time.monotonic()
+        return process_playlist(self.url, self)
+
+class ExtractionTimeout(Exception):
+    pass
+
+def wait_for(extraction, future, timeout):
+    # the clock starts when the source starts running, not while it is
+    # queued behind the provider cap
+    while True:
+        if future.done():
+            return future.result()
+        if extraction.started is None:
+            wait = 1
+        else:
+            wait = extraction.started + timeout - time.monotonic()
+            if wait <= 0:
+                raise ExtractionTimeout
+        try:
+            return future.result(timeout=wait)
+        except TimeoutError:
+            if future.done():
+                # the extractor's own timeout, not ours
+                raise
+            continue
+
+def extract_playlists(urls, timeout=None):
+    # sources run in parallel across providers, capped per provider.
+    # results come back in input order so the writes stay deterministic
+    executors = {provider: ThreadPoolExecutor(max_workers=workers) for provider, workers in PROVIDER_WORKERS.items()}
+    futures = []
+    try:
+        for url in urls:
+            if not (provider := get_provider(url)):
+                print(f"Invalid URL: {url}")
+                continue
+            extraction = Extraction(url, provider)
+            futures.append((extraction, executors[provider].submit(extraction.run)))
+        for extraction, future in futures:
+            url = extraction.url
+            try:
+                yield url, *wait_for(extraction, future, timeout or PROVIDER_TIMEOUTS[extraction.provider])
+            except ExtractionTimeout:
+                extraction.cancelled = True
+                if extraction.playlist_record and extraction.tracks:
+                    print(f"Timed out extracting {url}, mirroring the {len(extraction.tracks)} track(s) found so far")
+                    yield url, extraction.playlist_record, list(extraction.tracks)
+                else:
+                    print(f"Timed out extracting {url}")
+                    yield url, None, None
+            except Exception as e:
+                print(f"Failed to extract {url}: {e}")
+                yield url, None, None
+    finally:
+        # anything still running (the caller stopped early) winds down too
+        for extraction, _ in futures:
+            extraction.cancelled = True
+        for executor in executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+@stats.phase('extraction')
+def process_playlist(url, extraction=None):
     hostname = url.split('/')[2]
     if 'soundcloud' in hostname:
-        return sc_playlist(url)
+        return sc_playlist(url, extraction)
     if 'bandcamp' in hostname:
-        return bc_playlist(url)
+        return bc_playlist(url, extraction)
     elif 'youtu' in hostname:
-        return yt_playlist(url)
+        return yt_playlist(url, extraction)
+    elif 'spotify' in hostname:
+        from spotify import spotify_playlist
+        return spotify_playlist(url, extraction)
     else:
         print("Invalid URL")
         return None, None
 
-def find_or_create_playlist_uri(playlist_record, did, session, service):
-    if not playlist_record:
+# only what the index looks things up by is kept in memory
+PlaylistRecord = record_class("dev.dreary.tunes.playlist", ['name', 'reference', 'ordering'])
+TrackRecord = record_class("dev.dreary.tunes.track", ['url'])
+
+class TunesIndex:
+    # existing records are listed once per process and kept up to date as
+    # writes go out, so mirroring several sources doesn't re-list anything
+    @stats.phase('index load')
+    def __init__(self, did, service):
+        self.did = did
+        self.service = service
+        print("Retrieving existing playlist records...")
+        self.playlists = list(iter_records(did, service, PlaylistRecord))
+        print("Retrieving existing track records...")
+        self.track_uris = {track.url: track.uri for track in iter_records(did, service, TrackRecord) if track.url}
+        # playlistitems are listed on demand: a fractional playlist reads
+        # just its own items by rkey prefix, and only linked playlists (or
+        # --repair) need the whole collection
+        self.playlist_items = None
+        self.playlist_orders = {}
+
+    def all_playlist_items(self):
+        if self.playlist_items is None:
+            print("Retrieving existing playlistitem records...")
+            self.playlist_items = {}
+            with stats.phase('index load'):
+                for item in iter_records(self.did, self.service, PlaylistItem):
+                    self.playlist_items.setdefault(item.playlist, []).append(item)
+        return self.playlist_items
+
+    def find_playlist_uri(self, playlist_record):
+        for p in self.playlists:
+            if not isinstance((ref := p.reference), dict):
+                continue
+            if all(k in ref and ref[k] == v for k, v in playlist_record['reference'].items()):
+                return p.uri
         return None
 
-    print("Searching for existing playlist record matches...")
-    existing_playlist_records = list_records(did, service, "dev.dreary.tunes.playlist")
+    def add_playlist(self, uri, playlist_record):
+        self.playlists.append(PlaylistRecord.from_value(uri, playlist_record))
 
-    for p in existing_playlist_records:
-        if not isinstance((ref := traverse(p, ['value', 'reference'])), dict):
-            continue
-        if all(k in ref and ref[k] == v for k, v in playlist_record['reference'].items()):
-            playlist_uri = p['uri']
-            print('No playlist record creation')
-            break
-    else:
-        playlist_uri = create_record(session, service, playlist_record)
-    return playlist_uri
+    def playlist_ordering(self, playlist_uri):
+        playlist = next((p for p in self.playlists if p.uri == playlist_uri), None)
+        return (playlist and playlist.ordering) or 'linked'
 
-def split_list(lst, chunk_size):
-    return [lst[i:i + chunk_size] for i in range(0, len(lst), chunk_size)]
-
-def apply_writes_batch(session, service, records):
-    if len(records) == 0:
-        return []
-
-    writes = []
-    for record in records:
-        if record['$type'].split('#')[0] == 'com.atproto.repo.applyWrites':
-            # if the record is an applyWrites record, use it directly
-            # this allows for non-creation writes
-            writes.append(record)
-        else:
-            writes.append({
-                "$type": "com.atproto.repo.applyWrites#create",
-                "collection": record['$type'],
-                "value": record,
-            })
-
-    uri = []
-    split_batches = split_list(writes, 200)
-    total_batches = len(split_batches)
-    for i, batch in enumerate(split_batches):
-        response = apply_writes(session, service, batch)
-        uri.extend(traverse(response, ['results', 'uri'], get_all=True) or [])
-        print(f"{i+1}/{total_batches} applyWrites complete")
-    return uri
-
-def filter_track_uri(playlist_item_records, playlist_uri, track_uris):
-    filtered_items = traverse(playlist_item_records, ['value', {'playlist': playlist_uri, 'track': track_uris}, 'track'], get_all=True, default=[])
-    return [t for t in track_uris if t not in filtered_items]
-
-def main():
-    with open('../../config.json') as f:
-        config = json.load(f)
-    handle = config.get('HANDLE')
-    password = config.get('PASSWORD')
-    if not (handle and password):
-        print('Enter credentials in config.json')
-        return
-
-    did = resolve_handle(handle)
-    service = get_service_endpoint(did)
-    session = get_session(did, password, service)
-
-    if len(sys.argv) < 2:
-        playlist_url = input('Input a URL: ')
-        if playlist_url == '':
-            return
-    else:
-        playlist_url = sys.argv[1]
+    def playlist_order(self, playlist_uri):
+        if playlist_uri not in self.playlist_orders:
+            if self.playlist_ordering(playlist_uri) != 'fractional':
+                items = self.all_playlist_items().setdefault(playlist_uri, [])
+                self.playlist_orders[playlist_uri] = PlaylistOrder(playlist_uri, items)
+            elif self.playlist_items is not None:
+                self.playlist_orders[playlist_uri] = FractionalOrder(playlist_uri, self.playlist_items.setdefault(playlist_uri, []))
+            else:
+                print("Retrieving existing playlistitem records for this playlist...")
+                with stats.phase('index load'):
+                    items = list(iter_playlist_items(self.did, self.service, playlist_uri))
+                self.playlist_orders[playlist_uri] = FractionalOrder(playlist_uri, items)
+        return self.playlist_orders[playlist_uri]
 
-    playlist_record, tracks = process_playlist(playlist_url)
+def find_or_create_playlist_uri(playlist_record, index, session, service, ordering=None):
     if not playlist_record:
-        return
+        return None
 
-    playlist_uri = find_or_create_playlist_uri(playlist_record, did, session, service)
-    if not playlist_uri:
-        return
+    if (playlist_uri := index.find_playlist_uri(playlist_record)):
+        print('No playlist record creation')
+        return playlist_uri
 
-    print("Retrieving existing track records...")
-    track_records = list_records(did, service, "dev.dreary.tunes.track")
+    if ordering:
+        # only set on creation, existing playlists keep the mode they have
+        playlist_record['ordering'] = ordering
 
+    playlist_uri = create_record(session, service, playlist_record)
+    index.add_playlist(playlist_uri, playlist_record)
+    return playlist_uri
+
+def find_or_create_track_uris(tracks, index, session, service):
+    # tracks are deduped by url, both against the repo and within the
+    # batch. tracks without one can't be matched, so each gets its own record
     writes = []
-    track_uris = []
-    track_record_url_map = {url: track["uri"] for track in track_records if (url := traverse(track, ['value', 'url']))}
+    seen = set()
     for track in tracks:
-        if (track_uri := track_record_url_map.get(track.get('url'))):
-            track_uris.append(track_uri)
-        else:
-            writes.append(track)
+        if (url := track.get('url')):
+            if url in index.track_uris or url in seen:
+                continue
+            seen.add(url)
+        writes.append(track)
 
+    unmatched = {}
     if writes:
-        track_uris.extend(apply_writes_batch(session, service, writes))
+        for track, track_uri in zip(writes, apply_writes_batch(session, service, writes)):
+            if not track_uri:
+                continue
+            if (url := track.get('url')):
+                index.track_uris[url] = track_uri
+            else:
+                unmatched[id(track)] = track_uri
         print("Track applyWrites complete")
     else:
         print("No track record creation required")
 
-    print("Retrieving existing playlistitem records...")
-    playlist_item_records = list_records(did, service, "dev.dreary.tunes.playlistitem")
+    uris = (index.track_uris.get(url) if (url := track.get('url')) else unmatched.get(id(track)) for track in tracks)
+    return list(dict.fromkeys(uri for uri in uris if uri))
 
-    final_playlist_item = traverse(playlist_item_records, [{'value': {'playlist': playlist_uri, 'nodes': {'nextUri': None}}}])
-    track_uris = filter_track_uri(playlist_item_records, playlist_uri, track_uris)
-    last_index = len(track_uris) - 1
-    writes = []
-    for i, track_uri in enumerate(track_uris):
-
-        previous_uri = None
-        if final_playlist_item:
-            previous_uri = final_playlist_item['uri']
-            final_playlist_item = final_playlist_item['value']
-            final_playlist_item['nodes']['nextUri'] = track_uri
-            writes.append({
-                "$type": "com.atproto.repo.applyWrites#update",
-                "collection": "dev.dreary.tunes.playlistitem",
-                "rkey": decompose_uri(previous_uri)[2],
-                "value": final_playlist_item,
-            })
-            final_playlist_item = None
-        else:
-            previous_uri = track_uris[i-1] if i > 0 else None
+def link_playlist_items(playlist_uri, track_uris, index, session, service):
+    order = index.playlist_order(playlist_uri)
+    for problem in order.problems:
+        print(problem)
 
-        writes.append({
-            "$type": "dev.dreary.tunes.playlistitem",
-            "playlist": playlist_uri,
-            "track": track_uri,
-            "createdAt": generate_timestamp(),
-            "nodes": {
-                "previousUri": previous_uri,
-                "nextUri": track_uris[i+1] if i < last_index else None
-            }
-        })
+    if order.append(track_uris, generate_timestamp()):
+        order.flush(session, service)
+        print("playlistitem applyWrites complete")
+    else:
+        print("No playlistitem record creation required")
+
+def repair_playlists(index, session, service):
+    # relinks every playlist in resolved order, migrating playlistitem-v0
+    # index items and dropping duplicates, as one bulk set of writes
+    writes = []
+    for playlist_uri in [uri for uri in index.all_playlist_items() if uri]:
+        order = index.playlist_order(playlist_uri)
+        for problem in order.problems:
+            print(problem)
+        order.repair()
+        playlist_writes = order.writes()
+        order.applied(playlist_writes, [])
+        writes.extend(playlist_writes)
 
     if writes:
         apply_writes_batch(session, service, writes)
-        print("playlistitem applyWrites complete")
+        print(f"{len(writes)} playlistitem write(s) applied")
     else:
-        print("No playlistitem record creation required")
+        print("All playlists already consistent")
+
+def mirror_playlist(playlist_record, tracks, index, session, service, ordering=None):
+    playlist_uri = find_or_create_playlist_uri(playlist_record, index, session, service, ordering)
+    if not playlist_uri:
+        return None
+    track_uris = find_or_create_track_uris(tracks, index, session, service)
+    link_playlist_items(playlist_uri, track_uris, index, session, service)
+    return playlist_uri
+
+def read_playlist_urls(args, fallback=False):
+    urls = list(args.urls)
+    if args.batch:
+        with open(args.batch, 'r', encoding='utf-8') as f:
+            urls.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    if not urls and fallback:
+        # config PLAYLISTS are playlists to sync, never pages to crawl
+        urls.extend(load_config().get('PLAYLISTS') or [])
+    return list(dict.fromkeys(urls))
+
+def sync_playlists(playlist_urls, ordering=None, timeout=None):
+    did, service, session = login()
+    if not session:
+        return
+
+    index = None
+    mirrored = 0
+    for playlist_url, playlist_record, tracks in extract_playlists(playlist_urls, timeout):
+        if not playlist_record:
+            continue
+        print(f"Mirroring {playlist_url}")
+        # only list the repo once something actually needs mirroring
+        index = index or TunesIndex(did, service)
+        if mirror_playlist(playlist_record, tracks, index, session, service, ordering):
+            mirrored += 1
+    print(f"{mirrored}/{len(playlist_urls)} playlist(s) mirrored")
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Mirror YouTube, SoundCloud, Bandcamp and Spotify playlists to dev.dreary.tunes records.")
+    parser.add_argument('urls', nargs='*', help="playlist URLs to mirror")
+    parser.add_argument('--batch', metavar='FILE', help="file with one playlist URL per line")
+    parser.add_argument('--every', metavar='SECONDS', type=int, help="keep running and re-sync on this interval")
+    parser.add_argument('--timeout', metavar='SECONDS', type=int, help="per-source extraction timeout (default depends on provider)")
+    parser.add_argument('--ordering', choices=['linked', 'fractional'], help="ordering mode for newly created playlists (default linked)")
+    parser.add_argument('--crawl', action='store_true', help="treat the URLs as Bandcamp artist/label pages and mirror every release")
+    parser.add_argument('--repair', action='store_true', help="relink all playlists, migrating index-based playlistitems")
+    args = parser.parse_args(argv)
+    if args.crawl and not (music_urls := read_playlist_urls(args)):
+        parser.error("--crawl needs Bandcamp artist/label URLs (or --batch)")
+    stats.start('dreary_tunes')
+
+    if args.crawl:
+        did, service, session = login()
+        if not session:
+            return
+        index = TunesIndex(did, service)
+        for music_url in music_urls:
+            crawl_bandcamp(music_url, index, session, service, args.ordering)
+        return
+
+    if args.repair:
+        did, service, session = login()
+        if session:
+            repair_playlists(TunesIndex(did, service), session, service)
+        return
+
+    playlist_urls = read_playlist_urls(args, fallback=True)
+    if not playlist_urls:
+        playlist_url = input('Input a URL: ')
+        if playlist_url == '':
+            return
+        playlist_urls = [playlist_url]
+
+    while True:
+        sync_playlists(playlist_urls, args.ordering, args.timeout)
+        if not args.every:
+            return
+        # one summary per sync
+        stats.report()
+        stats.reset()
+        print(f"Next sync in {args.every}s")
+        time.sleep(args.every)
+        # pick up edits to the batch file between runs
+        playlist_urls = read_playlist_urls(args, fallback=True) or playlist_urls
 
 if __name__ == "__main__":
     main()
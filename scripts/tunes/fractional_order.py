@@ -0,0 +1,334 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from dreary_common.records import PAGE_SIZE, get_page
+from dreary_common.writes import apply_writes_batch
+from playlist_order import PlaylistItem
+
+# alternative to the linked nodes: each playlistitem carries a sortable
+# position string, and its rkey is "<playlist rkey>:<position>". the PDS
+# lists records in rkey order, so a playlist's items come back already
+# sorted and grouped, and adding an item never touches its neighbours.
+# positions are base62 with digits in ascii order, so string comparison
+# and the PDS's byte comparison agree.
+# a position is an integer part followed by an optional fraction (the
+# usual fractional indexing layout). the head character gives the integer
+# part's length: a-z are 2..27 characters counting up from "a0", A-Z the
+# same counting down, so appending or prepending just steps the integer
+# and keys stay O(log n) long. only repeated inserts into one gap grow the
+# fraction; past MAX_POSITION the whole playlist is re-spaced.
+
+COLLECTION = "dev.dreary.tunes.playlistitem"
+DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+INTEGER_ZERO = "a0"
+SMALLEST_INTEGER = "A" + DIGITS[0] * 26
+# the lexicon's maxLength for position; rkeys (512 max) have room for the
+# playlist rkey prefix on top
+MAX_POSITION = 480
+
+
+def midpoint(a, b):
+    # fractions, a < b, b=None means unbounded. neither ends in the zero
+    # digit, so there is always room for a key strictly between them
+    if b is not None:
+        n = 0
+        while n < len(b) and (a[n] if n < len(a) else DIGITS[0]) == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + midpoint(a[n:], b[n:])
+    digit_a = DIGITS.index(a[0]) if a else 0
+    digit_b = DIGITS.index(b[0]) if b is not None else len(DIGITS)
+    if digit_b - digit_a > 1:
+        return DIGITS[(digit_a + digit_b) // 2]
+    if b is not None and len(b) > 1:
+        return b[0]
+    return DIGITS[digit_a] + midpoint(a[1:], None)
+
+def integer_length(head):
+    if 'a' <= head <= 'z':
+        return ord(head) - ord('a') + 2
+    if 'A' <= head <= 'Z':
+        return ord('Z') - ord(head) + 2
+    raise ValueError(f"Invalid position head: {head}")
+
+def split_key(key):
+    length = integer_length(key[0]) if key else 0
+    if not key or length > len(key):
+        raise ValueError(f"Invalid position: {key}")
+    return key[:length], key[length:]
+
+def valid_position(key):
+    try:
+        integer, fraction = split_key(key)
+    except ValueError:
+        return False
+    return key != SMALLEST_INTEGER and all(c in DIGITS for c in key[1:]) and not fraction.endswith(DIGITS[0])
+
+def increment_integer(integer):
+    head, digits = integer[0], list(integer[1:])
+    for i in reversed(range(len(digits))):
+        if digits[i] != DIGITS[-1]:
+            digits[i] = DIGITS[DIGITS.index(digits[i]) + 1]
+            return head + ''.join(digits)
+        digits[i] = DIGITS[0]
+    # every digit carried, move to the next length
+    if head == 'Z':
+        return INTEGER_ZERO
+    if head == 'z':
+        return None
+    head = chr(ord(head) + 1)
+    return head + ''.join(digits + [DIGITS[0]] if head > 'a' else digits[:-1])
+
+def decrement_integer(integer):
+    head, digits = integer[0], list(integer[1:])
+    for i in reversed(range(len(digits))):
+        if digits[i] != DIGITS[0]:
+            digits[i] = DIGITS[DIGITS.index(digits[i]) - 1]
+            return head + ''.join(digits)
+        digits[i] = DIGITS[-1]
+    if head == 'a':
+        return 'Z' + DIGITS[-1]
+    if head == 'A':
+        return None
+    head = chr(ord(head) - 1)
+    return head + ''.join(digits + [DIGITS[-1]] if head < 'Z' else digits[:-1])
+
+def key_between(a, b):
+    # None on either side means unbounded
+    if a is not None and b is not None and a >= b:
+        raise ValueError(f"{a} is not before {b}")
+    if a is None and b is None:
+        return INTEGER_ZERO
+    if a is None:
+        integer, fraction = split_key(b)
+        if integer == SMALLEST_INTEGER:
+            return integer + midpoint('', fraction)
+        if fraction:
+            return integer
+        return decrement_integer(integer)
+    integer, fraction = split_key(a)
+    if b is None:
+        following = increment_integer(integer)
+        return following if following is not None else integer + midpoint(fraction, None)
+    integer_b, fraction_b = split_key(b)
+    if integer == integer_b:
+        return integer + midpoint(fraction, fraction_b)
+    following = increment_integer(integer)
+    return following if following is not None and following < b else integer + midpoint(fraction, None)
+
+def keys_between(a, b, count):
+    if count <= 0:
+        return []
+    # open ended runs just keep stepping the integer part
+    if b is None:
+        keys = []
+        for _ in range(count):
+            a = key_between(a, None)
+            keys.append(a)
+        return keys
+    if a is None:
+        keys = []
+        for _ in range(count):
+            b = key_between(None, b)
+            keys.append(b)
+        return keys[::-1]
+    # splitting a bounded range in half each time keeps keys ~log62(count)
+    # characters longer than the bounds instead of growing by one per key
+    mid = key_between(a, b)
+    return keys_between(a, mid, count // 2) + [mid] + keys_between(mid, b, count - count // 2 - 1)
+
+def rkey_of(uri):
+    return uri.rsplit('/', 1)[-1]
+
+def item_rkey(playlist_uri, position):
+    return f"{rkey_of(playlist_uri)}:{position}"
+
+def list_playlist_page(did, service, playlist_uri, limit=PAGE_SIZE, cursor=None):
+    # one page of a playlist, in order, without listing the rest of the
+    # collection. listRecords in reverse pages upwards from the cursor, and
+    # every item rkey sorts after the bare "<playlist rkey>:" prefix, so
+    # starting there lands on the first item
+    prefix = item_rkey(playlist_uri, "")
+    params = {
+        'repo': did,
+        'collection': COLLECTION,
+        'limit': limit,
+        'reverse': 'true',
+        'cursor': cursor or prefix,
+    }
+    records = get_page(f"{service}/xrpc/com.atproto.repo.listRecords", params).get('records') or []
+    items = [PlaylistItem.from_record(record) for record in records if rkey_of(record['uri']).startswith(prefix)]
+    # a record past the prefix means the playlist ended on this page
+    next_cursor = rkey_of(items[-1].uri) if len(items) == len(records) == limit else None
+    return [item for item in items if item.playlist == playlist_uri], next_cursor
+
+def iter_playlist_items(did, service, playlist_uri):
+    cursor = None
+    while True:
+        items, cursor = list_playlist_page(did, service, playlist_uri, cursor=cursor)
+        yield from items
+        if not cursor:
+            return
+
+class FractionalOrder:
+    # same interface as playlist_order.PlaylistOrder
+    def __init__(self, playlist_uri, items):
+        self.playlist_uri = playlist_uri
+        self.item_list = items
+        self.items = {}
+        self.created = []
+        self.deleted = []
+        self.duplicates = []
+        self.problems = []
+        for item in items:
+            key = item.track
+            if key in self.items:
+                self.problems.append(f"Duplicate playlistitem for {key}: {item.uri}")
+                self.duplicates.append(item)
+                continue
+            if not item.position:
+                self.problems.append(f"playlistitem without position: {item.uri}")
+                item.position = None
+            elif not valid_position(item.position):
+                # written by the older position scheme, or by hand
+                self.problems.append(f"playlistitem with an unusable position: {item.uri}")
+            self.items[key] = item
+        self.sort()
+
+    def sort(self):
+        self.order = sorted(self.items, key=lambda key: (self.items[key].position is None, self.items[key].position or ''))
+
+    def __iter__(self):
+        return iter(list(self.order))
+
+    def __contains__(self, track_uri):
+        return track_uri in self.items
+
+    def ordered_items(self):
+        return [self.items[key] for key in self.order]
+
+    def position(self, key):
+        return self.items[key].position if key is not None else None
+
+    def neighbours(self, after):
+        # positions either side of the slot following `after` (None = head)
+        if after is None:
+            return None, self.position(self.order[0]) if self.order else None
+        i = self.order.index(after)
+        return self.position(after), self.position(self.order[i + 1]) if i + 1 < len(self.order) else None
+
+    def unpositioned(self):
+        return [key for key in self.order if not valid_position(self.position(key))]
+
+    def reposition(self, keys):
+        # fresh positions for `keys`, keeping the current order. each run of
+        # them gets spread between the usable positions either side
+        targets = set(keys)
+        run = []
+        lower = None
+        for key in self.order + [None]:
+            if key in targets:
+                run.append(key)
+                continue
+            upper = self.position(key)
+            for run_key, position in zip(run, keys_between(lower, upper, len(run))):
+                self.set_position(run_key, position)
+            run = []
+            lower = upper
+        self.sort()
+
+    def set_position(self, key, position):
+        # the rkey holds the position, so moving a stored item is a delete
+        # and a create
+        item = self.items[key]
+        if item.position == position:
+            return
+        if key not in self.created:
+            self.deleted.append(item)
+            self.created.append(key)
+            self.items[key] = item = PlaylistItem.from_value(None, item.to_value())
+        item.position = position
+
+    def ensure_positions(self):
+        # every neighbour has to be a usable position before new keys can
+        # be placed between them
+        if (unpositioned := self.unpositioned()):
+            self.reposition(unpositioned)
+
+    def new_item(self, track_uri, created_at, position):
+        self.items[track_uri] = PlaylistItem(playlist=self.playlist_uri, track=track_uri, createdAt=created_at, position=position)
+        self.created.append(track_uri)
+
+    def append(self, track_uris, created_at):
+        self.ensure_positions()
+        track_uris = [t for t in dict.fromkeys(track_uris) if t not in self.items]
+        tail = self.position(self.order[-1]) if self.order else None
+        for track_uri, position in zip(track_uris, keys_between(tail, None, len(track_uris))):
+            self.new_item(track_uri, created_at, position)
+            self.order.append(track_uri)
+        return len(track_uris)
+
+    def insert(self, track_uri, created_at, after=None):
+        if track_uri in self.items:
+            return self.move(track_uri, after)
+        self.ensure_positions()
+        self.new_item(track_uri, created_at, key_between(*self.neighbours(after)))
+        self.sort()
+
+    def move(self, track_uri, after=None):
+        if track_uri == after:
+            return
+        self.ensure_positions()
+        self.order.remove(track_uri)
+        self.set_position(track_uri, key_between(*self.neighbours(after)))
+        self.sort()
+
+    def remove(self, track_uri):
+        item = self.items.pop(track_uri)
+        self.order.remove(track_uri)
+        if track_uri in self.created:
+            self.created.remove(track_uri)
+        else:
+            self.deleted.append(item)
+
+    def repair(self):
+        self.deleted.extend(self.duplicates)
+        self.duplicates = []
+        # unpositioned items sort last, so they land after the tail
+        self.ensure_positions()
+
+    def writes(self):
+        if any(len(self.position(key)) > MAX_POSITION for key in self.created):
+            # one gap took too many inserts, space the playlist out again
+            self.reposition(self.order)
+        writes = [{
+            "$type": "com.atproto.repo.applyWrites#delete",
+            "collection": COLLECTION,
+            "rkey": rkey_of(item.uri),
+        } for item in self.deleted]
+        for key in self.created:
+            item = self.items[key]
+            writes.append({
+                "$type": "com.atproto.repo.applyWrites#create",
+                "collection": COLLECTION,
+                "rkey": item_rkey(self.playlist_uri, item.position),
+                "value": item.to_value(),
+            })
+        return writes
+
+    def applied(self, writes, uris):
+        deleted = {id(item) for item in self.deleted}
+        self.item_list[:] = [item for item in self.item_list if id(item) not in deleted]
+        for key in self.created:
+            item = self.items[key]
+            item.uri = f"at://{self.playlist_uri.split('/')[2]}/{COLLECTION}/{item_rkey(self.playlist_uri, item.position)}"
+            self.item_list.append(item)
+        self.created.clear()
+        self.deleted.clear()
+
+    def flush(self, session, service):
+        writes = self.writes()
+        if writes:
+            self.applied(writes, apply_writes_batch(session, service, writes))
+        return len(writes)
@@ -0,0 +1,265 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from dreary_common.records import record_class
+from dreary_common.writes import apply_writes_batch
+
+# dev.dreary.tunes.playlistitem records form a doubly linked list through
+# nodes.previousUri/nodes.nextUri. the links hold *track* uris (a track is
+# only ever on a playlist once), though older writes linked the first item
+# of an append to the previous tail's item uri, so both are accepted when
+# reading. everything below is keyed by track uri.
+
+COLLECTION = "dev.dreary.tunes.playlistitem"
+# every field the lexicon (and playlistitem-v0) defines, since updates
+# are written back from these
+PlaylistItem = record_class(COLLECTION, ['playlist', 'track', 'createdAt', 'nodes', 'position', 'index'])
+
+
+def rkey_of(uri):
+    return uri.rsplit('/', 1)[-1]
+
+class PlaylistOrder:
+    def __init__(self, playlist_uri, items):
+        self.playlist_uri = playlist_uri
+        # shared with the caller's index so created items show up there too
+        self.item_list = items
+        self.items = {}
+        self.item_keys = {}
+        self.prev = {}
+        self.next = {}
+        self.head = None
+        self.tail = None
+        self.dirty = set()
+        self.created = []
+        self.deleted = []
+        self.duplicates = []
+        self.problems = []
+        self.build()
+
+    def key_for(self, uri):
+        if uri is None:
+            return None
+        return uri if uri in self.items else self.item_keys.get(uri)
+
+    def build(self):
+        legacy = []
+        for item in self.item_list:
+            key = item.track
+            if key in self.items:
+                self.problems.append(f"Duplicate playlistitem for {key}: {item.uri}")
+                self.duplicates.append(item)
+                continue
+            self.items[key] = item
+            self.item_keys[item.uri] = key
+            if item.nodes is None:
+                legacy.append(item)
+
+        stored_next = {}
+        stored_prev = {}
+        for key, item in self.items.items():
+            if item.nodes is None:
+                continue
+            for direction, stored in [('nextUri', stored_next), ('previousUri', stored_prev)]:
+                uri = item.nodes.get(direction)
+                stored[key] = self.key_for(uri)
+                if uri is not None and stored[key] is None:
+                    self.problems.append(f"Broken {direction} on {item.uri}: {uri}")
+
+        # playlistitem-v0 records carry an index instead of nodes. they
+        # predate the linked form, so they go first, in index order
+        order = [item.track for item in sorted(legacy, key=lambda i: i.index or 0)]
+        visited = set(order)
+        self.dirty.update(order)
+
+        linked = [key for key in self.items if key not in visited]
+        created_at = lambda key: self.items[key].createdAt or ''
+        heads = sorted((key for key in linked if stored_prev.get(key) is None), key=created_at)
+        if len(heads) > 1:
+            self.problems.append(f"Playlist {self.playlist_uri} has {len(heads)} heads")
+
+        # walk every chain once. whatever is left unvisited afterwards sits
+        # on a cycle or behind a duplicate link and is appended in creation
+        # order so nothing gets lost
+        for start in heads + sorted(linked, key=created_at):
+            key = start
+            while key is not None and key not in visited:
+                visited.add(key)
+                order.append(key)
+                following = stored_next.get(key)
+                if following in visited:
+                    self.problems.append(f"Link from {self.items[key].uri} revisits {following}")
+                    break
+                if following is not None and stored_prev.get(following) != key:
+                    self.problems.append(f"Mismatched links between {self.items[key].uri} and {self.items[following].uri}")
+                key = following
+
+        for previous, key in zip([None] + order, order):
+            self.link(previous, key)
+        if legacy and len(order) > len(legacy):
+            # the old head now points back into the migrated items
+            self.dirty.add(order[len(legacy)])
+        self.tail = order[-1] if order else None
+        # links that don't match the resolved order are only rewritten on
+        # repair(), or when an edit touches them anyway
+        self.stale = {key for key in order if self.stored_nodes(key) != self.nodes_for(key)}
+
+    def link(self, previous, key):
+        self.prev[key] = previous
+        if previous is None:
+            self.head = key
+        else:
+            self.next[previous] = key
+        self.next.setdefault(key, None)
+
+    def stored_nodes(self, key):
+        nodes = self.items[key].nodes or {}
+        return {
+            "previousUri": self.key_for(nodes.get('previousUri')),
+            "nextUri": self.key_for(nodes.get('nextUri')),
+        }
+
+    def nodes_for(self, key):
+        return {
+            "previousUri": self.prev.get(key),
+            "nextUri": self.next.get(key),
+        }
+
+    def __iter__(self):
+        key = self.head
+        while key is not None:
+            yield key
+            key = self.next.get(key)
+
+    def __contains__(self, track_uri):
+        return track_uri in self.items
+
+    def ordered_items(self):
+        return [self.items[key] for key in self]
+
+    def detach(self, key):
+        previous, following = self.prev.get(key), self.next.get(key)
+        if previous is None:
+            self.head = following
+        else:
+            self.next[previous] = following
+            self.dirty.add(previous)
+        if following is None:
+            self.tail = previous
+        else:
+            self.prev[following] = previous
+            self.dirty.add(following)
+        self.prev[key] = self.next[key] = None
+
+    def attach(self, key, after):
+        following = self.head if after is None else self.next.get(after)
+        self.prev[key] = after
+        self.next[key] = following
+        if after is None:
+            self.head = key
+        else:
+            self.next[after] = key
+            self.dirty.add(after)
+        if following is None:
+            self.tail = key
+        else:
+            self.prev[following] = key
+            self.dirty.add(following)
+        self.dirty.add(key)
+
+    def new_item(self, track_uri, created_at):
+        self.items[track_uri] = PlaylistItem(playlist=self.playlist_uri, track=track_uri, createdAt=created_at)
+        self.created.append(track_uri)
+        return track_uri
+
+    def append(self, track_uris, created_at):
+        # only the current tail and the new items are touched
+        added = 0
+        for track_uri in track_uris:
+            if track_uri in self.items:
+                continue
+            self.attach(self.new_item(track_uri, created_at), self.tail)
+            added += 1
+        return added
+
+    def insert(self, track_uri, created_at, after=None):
+        if track_uri in self.items:
+            return self.move(track_uri, after)
+        self.attach(self.new_item(track_uri, created_at), after)
+
+    def move(self, track_uri, after=None):
+        if track_uri == after or self.prev.get(track_uri) == after:
+            return
+        self.detach(track_uri)
+        self.attach(track_uri, after)
+
+    def remove(self, track_uri):
+        self.detach(track_uri)
+        item = self.items.pop(track_uri)
+        self.dirty.discard(track_uri)
+        if track_uri in self.created:
+            self.created.remove(track_uri)
+        else:
+            self.deleted.append(item)
+
+    def repair(self):
+        self.dirty.update(self.stale)
+        self.deleted.extend(self.duplicates)
+        self.duplicates = []
+
+    def writes(self):
+        writes = []
+        for key in self.dirty:
+            if key in self.created or key not in self.items:
+                continue
+            item = self.items[key]
+            nodes = self.nodes_for(key)
+            if item.nodes == nodes and item.index is None:
+                continue
+            # migrated v0 items drop their index
+            item.nodes = nodes
+            item.index = None
+            writes.append({
+                "$type": "com.atproto.repo.applyWrites#update",
+                "collection": COLLECTION,
+                "rkey": rkey_of(item.uri),
+                "value": item.to_value(),
+            })
+        for item in self.deleted:
+            writes.append({
+                "$type": "com.atproto.repo.applyWrites#delete",
+                "collection": COLLECTION,
+                "rkey": rkey_of(item.uri),
+            })
+        for key in self.created:
+            self.items[key].nodes = self.nodes_for(key)
+            writes.append(self.items[key].to_value())
+        self.stale -= self.dirty
+        self.dirty.clear()
+        return writes
+
+    def applied(self, writes, uris):
+        # applyWrites returns a uri for every create and update, in order.
+        # creates are the bare records, written in self.created order
+        results = iter(uris)
+        created = iter([self.items[key] for key in self.created])
+        for write in writes:
+            if write['$type'] == "com.atproto.repo.applyWrites#delete":
+                continue
+            uri = next(results, None)
+            if write['$type'] == COLLECTION:
+                item = next(created)
+                item.uri = uri
+                self.item_keys[uri] = item.track
+                self.item_list.append(item)
+        deleted = {id(item) for item in self.deleted}
+        self.item_list[:] = [item for item in self.item_list if id(item) not in deleted]
+        self.created.clear()
+        self.deleted.clear()
+
+    def flush(self, session, service):
+        writes = self.writes()
+        if writes:
+            self.applied(writes, apply_writes_batch(session, service, writes))
+        return len(writes)
@@ -1,34 +1,95 @@
+import argparse
 import base64
 import json
 import os
 import sys
+import threading
+import time
 import webbrowser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from urllib.parse import urlparse
 
 import requests
 from bsky_utils import *
-from dotenv import load_dotenv
-
-def get_token():
-    load_dotenv()
-    client_id = os.getenv("CLIENT_ID")
-    client_secret = os.getenv("CLIENT_SECRET")
-    auth_bytes = f"{client_id}:{client_secret}".encode()
-    auth_string = base64.b64encode(auth_bytes).decode()
-    response = requests.post(
-        "https://accounts.spotify.com/api/token",
-        data={"grant_type": "client_credentials"},
-        headers={
-            "Authorization": f"Basic {auth_string}",
-            "Content-Type": "application/x-www-form-urlencoded"
-        }
-    )
-    response.raise_for_status()
-    return response.json()["access_token"]
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from dreary_common import stats
+from dreary_common.cache import load_cache, save_cache
+from dreary_common.config import login
+from dreary_common.http_cache import cached_get
+from dreary_common.writes import split_list
+
+API = "https://api.spotify.com/v1"
+# max page sizes accepted by the paging endpoints
+PLAYLIST_PAGE_SIZE = 100
+ALBUM_PAGE_SIZE = 50
+PAGE_WORKERS = 8
+# playlists change, so cached responses are revalidated (etag) after an hour
+SPOTIFY_CACHE_TTL = 60 * 60
+# max ids accepted by the multi-id lookup endpoints
+TRACK_IDS_LIMIT = 50
+ALBUM_IDS_LIMIT = 20
+
+class SpotifyToken:
+    CACHE_NAME = 'spotify-token.json'
+    # refresh a little early so a request never goes out with a token
+    # that expires in flight
+    REFRESH_MARGIN = 120
+
+    def __init__(self):
+        from dotenv import load_dotenv
+        load_dotenv()
+        self.client_id = os.getenv("CLIENT_ID")
+        self.client_secret = os.getenv("CLIENT_SECRET")
+        self.lock = threading.Lock()
+        self.access_token = None
+        self.expires_at = 0
+        cached = load_cache(self.CACHE_NAME) or {}
+        if cached.get('client_id') == self.client_id:
+            self.access_token = cached.get('access_token')
+            self.expires_at = cached.get('expires_at') or 0
+
+    def get(self):
+        # shared by every page fetcher thread; only one of them refreshes
+        with self.lock:
+            if not self.access_token or time.time() >= self.expires_at - self.REFRESH_MARGIN:
+                self.refresh()
+            return self.access_token
+
+    def invalidate(self, stale_token):
+        with self.lock:
+            if self.access_token == stale_token:
+                self.access_token = None
+
+    def refresh(self):
+        auth_bytes = f"{self.client_id}:{self.client_secret}".encode()
+        auth_string = base64.b64encode(auth_bytes).decode()
+        response = requests.post(
+            "https://accounts.spotify.com/api/token",
+            data={"grant_type": "client_credentials"},
+            headers={
+                "Authorization": f"Basic {auth_string}",
+                "Content-Type": "application/x-www-form-urlencoded"
+            }
+        )
+        response.raise_for_status()
+        data = response.json()
+        self.access_token = data["access_token"]
+        self.expires_at = time.time() + data.get("expires_in", 3600)
+        save_cache(self.CACHE_NAME, {
+            "client_id": self.client_id,
+            "access_token": self.access_token,
+            "expires_at": self.expires_at,
+        })
 
 def get_api(token, api):
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(api, headers=headers)
+    access_token = token.get()
+    response = cached_get(api, headers={"Authorization": f"Bearer {access_token}"}, ttl=SPOTIFY_CACHE_TTL)
+    if response.status_code == 401:
+        # revoked or clock-skewed token; refresh once and retry
+        token.invalidate(access_token)
+        response = cached_get(api, headers={"Authorization": f"Bearer {token.get()}"}, ttl=SPOTIFY_CACHE_TTL)
     response.raise_for_status()
     return response.json()
 
@@ -46,12 +107,8 @@ def create_playlist_record(data, owners, thumbnail):
         }
     }
 
-def create_track_records(token, tracks, thumbnail):
-    if not tracks.get('items'):
-        print("No tracks provided.")
-        return None
-
-    records = [{
+def create_track_record(track, thumbnail):
+    return {
         "$type": "dev.dreary.tunes.track",
         "title": track.get('name'),
         "artists": [{
@@ -65,20 +122,38 @@ def create_track_records(token, tracks, thumbnail):
         "id": track.get('id'),
         "source": "Spotify",
         "createdAt": generate_timestamp(),
-    } for track in tracks.get('items', [])]
-    
-    if url := tracks.get('next'):
-        records.append(process_tracks(token, url, thumbnail))
+    }
+
+def iter_pages(token, first_page, base_url, page_size):
+    # the first page is embedded in the playlist/album response. its total
+    # gives every remaining offset up front, so the rest are fetched in
+    # parallel instead of following 'next' one request at a time
+    yield first_page
+    start = (first_page.get('offset') or 0) + len(first_page.get('items') or [])
+    total = first_page.get('total') or 0
+    urls = [f"{base_url}?offset={offset}&limit={page_size}" for offset in range(start, total, page_size)]
+    if not urls:
+        return
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+        # map yields in submission order, so tracks keep playlist order
+        yield from executor.map(lambda url: get_api(token, url), urls)
 
-    return records
+def iter_track_records(pages, thumbnail, unwrap=False):
+    for page in pages:
+        for item in page.get('items') or []:
+            # playlist pages wrap each track in an item with added_at etc
+            track = item.get('track') if unwrap else item
+            # local files and removed tracks come back as null or without an id
+            if not track or not track.get('id'):
+                continue
+            yield create_track_record(track, thumbnail)
 
 def process_playlist(token, playlist_id):
     # https://open.spotify.com/playlist/2HuVbuhG6UwyM0Ygegghxc?pi=u-yOp1Xya2T8aX
-    data = get_api(token, f"https://api.spotify.com/v1/playlists/{playlist_id}?limit=50")
+    data = get_api(token, f"{API}/playlists/{playlist_id}")
     if not data:
         return None, None
-    save_json(data)
-    
+
     thumbnail = traverse(data, ['images', 'url'])
     owners = [{
         "name": traverse(data, ['owner', 'display_name']),
@@ -86,20 +161,18 @@ def process_playlist(token, playlist_id):
         "id": traverse(data, ['owner', 'id'])
     }]
 
+    pages = iter_pages(token, data.get('tracks') or {}, f"{API}/playlists/{playlist_id}/tracks", PLAYLIST_PAGE_SIZE)
     return (
         create_playlist_record(data, owners, thumbnail),
-        create_track_records(token, {"items": traverse(data, ['tracks', 'items', 'track'], get_all=True)}, None)
+        iter_track_records(pages, None, unwrap=True)
     )
 
-def process_tracks(token, url, thumbnail):
-    return create_track_records(token, get_api(token, url), thumbnail)
-
 def process_album(token, album_id):
     # https://open.spotify.com/album/5QJlwvAXmPBLymGvbqKzdQ
-    album = get_api(token, f"https://api.spotify.com/v1/albums/{album_id}")
+    album = get_api(token, f"{API}/albums/{album_id}")
     if not album:
-        return None
-    
+        return None, None
+
     thumbnail = traverse(album, ['images', 'url'])
     owners = [{
         "name": artist.get('name'),
@@ -107,21 +180,117 @@ def process_album(token, album_id):
         "link": traverse(artist, ['external_urls', 'spotify']),
     } for artist in album.get('artists')]
 
+    pages = iter_pages(token, album.get('tracks') or {}, f"{API}/albums/{album_id}/tracks", ALBUM_PAGE_SIZE)
     return (
         create_playlist_record(album, owners, thumbnail),
-        create_track_records(token, album.get('tracks'), thumbnail)
+        iter_track_records(pages, thumbnail)
     )
 
 def process_track(token, track_id):
     # https://open.spotify.com/track/6hzwfFKrTabeUsW5SWti17
-    track = get_api(token, f"https://api.spotify.com/v1/tracks/{track_id}")
-    return create_track_records(token, {'items': [track]}, None)
+    track = get_api(token, f"{API}/tracks/{track_id}")
+    return create_track_record(track, None) if track else None
+
+def parse_spotify_id(value):
+    # accepts open.spotify.com links, spotify:kind:id uris and bare track ids
+    value = value.strip()
+    if value.startswith("spotify:"):
+        parts = value.split(":")
+        return (parts[1], parts[2]) if len(parts) == 3 else (None, None)
+    if "://" not in value:
+        return ("track", value) if value.isalnum() else (None, None)
+    parsed = urlparse(value)
+    if parsed.netloc != "open.spotify.com":
+        return None, None
+    # links can carry a locale prefix, e.g. /intl-de/track/<id>
+    parts = [p for p in parsed.path.split("/") if p and not p.startswith("intl-")]
+    return (parts[0], parts[1]) if len(parts) >= 2 else (None, None)
+
+def read_bulk_inputs(args):
+    # each arg is either a link/id or a file with one link/id per line
+    inputs = []
+    for arg in args:
+        if os.path.isfile(arg):
+            with open(arg, 'r', encoding='utf-8') as f:
+                inputs.extend(line for line in f.read().splitlines() if line.strip() and not line.startswith('#'))
+        else:
+            inputs.append(arg)
+
+    ids = {"track": {}, "album": {}}
+    for value in inputs:
+        kind, spotify_id = parse_spotify_id(value)
+        if kind not in ids:
+            print(f"Skipping unsupported input: {value}")
+            continue
+        ids[kind][spotify_id] = None
+    return list(ids["track"]), list(ids["album"])
+
+def lookup_tracks(token, track_ids):
+    urls = [f"{API}/tracks?ids={','.join(chunk)}" for chunk in split_list(track_ids, TRACK_IDS_LIMIT)]
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+        for data in executor.map(lambda url: get_api(token, url), urls):
+            for track in data.get('tracks') or []:
+                # unknown ids come back as null
+                if track:
+                    yield create_track_record(track, None)
 
-def main():
-    if len(sys.argv) < 2:
-        print("Enter a URL")
+def lookup_albums(token, album_ids):
+    urls = [f"{API}/albums?ids={','.join(chunk)}" for chunk in split_list(album_ids, ALBUM_IDS_LIMIT)]
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+        for data in executor.map(lambda url: get_api(token, url), urls):
+            for album in data.get('albums') or []:
+                if not album:
+                    continue
+                thumbnail = traverse(album, ['images', 'url'])
+                pages = iter_pages(token, album.get('tracks') or {}, f"{API}/albums/{album['id']}/tracks", ALBUM_PAGE_SIZE)
+                yield from iter_track_records(pages, thumbnail)
+
+def bulk_import(args):
+    # python spotify.py bulk [LINKS, IDS OR FILES...]
+    track_ids, album_ids = read_bulk_inputs(args)
+    if not (track_ids or album_ids):
+        print("No Spotify tracks or albums provided.")
+        return
+
+    from dreary_tunes import TunesIndex, find_or_create_track_uris
+    did, service, session = login()
+    if not session:
         return
-    link = sys.argv[1]
+
+    token = SpotifyToken()
+    print(f"Looking up {len(track_ids)} track(s) and {len(album_ids)} album(s)...")
+    tracks = [*lookup_tracks(token, track_ids), *lookup_albums(token, album_ids)]
+
+    index = TunesIndex(did, service)
+    track_uris = find_or_create_track_uris(tracks, index, session, service)
+    print(f"{len(track_uris)} track record(s) mirrored")
+
+def spotify_playlist(url, extraction=None):
+    # dreary_tunes extractor entry point, same (playlist, tracks) shape as
+    # the bandcamp/soundcloud/youtube extractors
+    kind, spotify_id = parse_spotify_id(url)
+    token = SpotifyToken()
+    if kind == "playlist":
+        playlist, tracks = process_playlist(token, spotify_id)
+    elif kind == "album":
+        playlist, tracks = process_album(token, spotify_id)
+    else:
+        print(f"Link type not supported: {kind}")
+        return None, None
+    if not playlist:
+        return None, None
+    track_list = extraction.start(playlist) if extraction else []
+    track_list.extend(tracks or [])
+    return playlist, track_list
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Mirror a Spotify playlist, album or track to dev.dreary.tunes records.")
+    parser.add_argument('inputs', nargs='+', metavar='URL', help="a Spotify link, or `bulk` followed by links, ids or files of them")
+    args = parser.parse_args(argv)
+    stats.start('spotify')
+    if args.inputs[0] == "bulk":
+        return bulk_import(args.inputs[1:])
+    link = args.inputs[0]
 
     parsed = None
     try:
@@ -133,32 +302,32 @@ def main():
         print("URL is not a Spotify link")
         return
 
-    token = get_token()
-
-    parts = parsed.path.split("/")
-    if parts[1] == "playlist":
-        playlist, tracks = process_playlist(token, parts[2])
-    elif parts[1] == "album":
-        playlist, tracks = process_album(token, parts[2])
-    elif parts[1] == "track":
-        record = process_track(token, parts[2])
-        # if not record: return
-        # create_record(session, service, record)
-        return
-    else:
-        print(f"Link type not supported: {parts[1]}")
+    from dreary_tunes import TunesIndex, find_or_create_track_uris, mirror_playlist
+
+    kind, spotify_id = parse_spotify_id(link)
+    if kind == "track":
+        track = process_track(SpotifyToken(), spotify_id)
+        if not track:
+            print("No track record returned.")
+            return
+        did, service, session = login()
+        if not session:
+            return
+        find_or_create_track_uris([track], TunesIndex(did, service), session, service)
         return
-    
+
+    playlist, tracks = spotify_playlist(link)
     if not tracks:
         print("No tracks record returned.")
         return
     elif not playlist:
         print("No playlist record returned.")
-        # apply_writes_create(tracks)
         return
 
-    print_json(tracks)
-    print("Here's where I pass on the logic to my existing tunes script")
+    did, service, session = login()
+    if not session:
+        return
+    mirror_playlist(playlist, tracks, TunesIndex(did, service), session, service)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()